@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+# runs the scrape against a fake eshop that injects errors, throttling, slow responses and
+# overload, and checks that the results are the same as with a well-behaved server
+
+import os
+import sys
+import io
+import time
+import tempfile
+import importlib
+import contextlib
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..'))
+sys.path.insert(0, here)
+import eat
+from catalog import make_catalog
+from fakeshop import FakeShop
+
+regions = ['US', 'GB', 'JP', 'DE', 'FR', 'AU']
+titles_per_region = 400
+workers = 16
+
+scenarios = [
+    ('clean', {}),
+    ('5% errors', {'error_rate': 0.05}),
+    ('2% throttled', {'throttle_rate': 0.02}),
+    ('1% timeouts', {'slow_rate': 0.01, 'slow_latency': 2.5}),
+    ('capacity 4', {'capacity': 4}),
+]
+
+
+def run(catalog, faults):
+    # full run with a fresh module, returns seconds, output files and the request metrics
+    importlib.reload(eat)
+    shop = FakeShop(catalog, 0.01, **faults).start()
+    shop.point_eat_at(eat)
+    eat.langs = regions
+    eat.fetch_threads = workers
+    eat.fetch_timeout = (2, 2)
+    eat.cache_enabled = False
+
+    outputs = {}
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            for d in (eat.dumpdest, eat.resultdest):
+                os.makedirs(d)
+            for f in ('ctr-common-1.crt', 'ctr-common-1.key'):
+                open(f, 'w').close()
+            t = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                eat.get_3dsdb_content()
+                eat.get_eshop_content()
+                eat.analyse_3dsdb(False)
+                eat.add_eshop_prices('EUR')
+                eat.build_eshop_analysis()
+            sec = time.perf_counter() - t
+            for d in (eat.dumpdest, eat.resultdest):
+                for f in sorted(os.listdir(d)):
+                    with open(d + '/' + f, 'rb') as fo:
+                        outputs[d + '/' + f] = fo.read()
+        finally:
+            os.chdir(cwd)
+            shop.stop()
+    limit = eat.host_limiters['127.0.0.1'].limit
+    return sec, outputs, dict(eat.metrics_endpoints), shop.faults, limit
+
+
+if __name__ == '__main__':
+    catalog = make_catalog(regions, titles_per_region, 0.8)
+    results = []
+    for name, faults in scenarios:
+        results.append((name, ) + run(catalog, faults))
+
+    print('\n')
+    print('scenario       seconds   requests   retries   faults   end limit   same output')
+    failed = 0
+    for name, sec, outputs, metrics, faults, limit in results:
+        same = outputs == results[0][2]
+        failed += not same
+        print(name.ljust(12), ('%.2f' % sec).rjust(9), str(sum(m['requests'] for m in metrics.values())).rjust(10), str(sum(m['retries'] for m in metrics.values())).rjust(9),
+              str(sum(faults.values())).rjust(8), ('%.1f' % limit).rjust(11), str(same).rjust(13))
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+
+# times merge_eshop_content for growing catalog sizes, time per title should stay flat
+
+import os
+import sys
+import time
+from xml.etree import ElementTree
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import eat
+
+
+def make_content(i):
+    cn = ElementTree.Element('content')
+    cn.set('index', str(i + 1))
+    tt = ElementTree.SubElement(cn, 'title')
+    tt.set('id', str(50010000000000 + i))
+    ElementTree.SubElement(tt, 'name').text = 'Title ' + str(i)
+    ElementTree.SubElement(tt, 'product_code').text = 'CTR-N-' + format(i, '04X')
+    ElementTree.SubElement(tt, 'platform').set('id', '18')
+    pub = ElementTree.SubElement(tt, 'publisher')
+    pub.set('id', '1')
+    ElementTree.SubElement(pub, 'name').text = 'Publisher'
+    ElementTree.SubElement(tt, 'display_genre').text = 'Action'
+    for tag in ('retail_sales', 'eshop_sales', 'demo_available', 'aoc_available'):
+        ElementTree.SubElement(tt, tag).text = 'false'
+    ElementTree.SubElement(tt, 'release_date_on_eshop').text = '2015-01-01'
+    sr = ElementTree.SubElement(tt, 'star_rating_info')
+    ElementTree.SubElement(sr, 'score').text = '5.0'
+    for tag in ('votes', 'star1', 'star2', 'star3', 'star4', 'star5'):
+        ElementTree.SubElement(sr, tag).text = '1'
+    return cn
+
+
+def bench_merge(count, regions):
+    eat.langs = regions
+    eat.merged_eshop_titles.clear()
+    eat.merged_eshop_index.clear()
+
+    # every region lists the whole catalog, so all but the first region are duplicates
+    listings = [[(make_content(i), l) for i in range(count)] for l in regions]
+    t = time.perf_counter()
+    for listing in listings:
+        for cn, l in listing:
+            eat.merge_eshop_content(cn, cn.find('title').find('product_code').text, l)
+    return time.perf_counter() - t
+
+
+if __name__ == '__main__':
+    regions = eat.langs_main
+    print('titles   regions   seconds   usec/title')
+    for count in (1000, 2000, 4000, 8000, 16000):
+        sec = bench_merge(count, regions)
+        print(str(count).rjust(6), str(len(regions)).rjust(9), ('%.3f' % sec).rjust(9), ('%.1f' % (sec * 1e6 / (count * len(regions)))).rjust(12))
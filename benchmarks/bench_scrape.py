@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+
+# times get_eshop_content against a local stand-in samurai server, serial vs parallel threads
+# and processes. threads split across processes, so 16 threads on 4 processes is 4 each.
+
+import os
+import sys
+import time
+import tempfile
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..'))
+sys.path.insert(0, here)
+import eat
+from catalog import make_catalog
+from fakeshop import FakeShop
+
+latency = 0.1
+titles_per_region = 1000
+regions = eat.langs_main
+
+
+def run_scrape(threads, processes, outdir):
+    eat.langs = regions
+    eat.fetch_threads = threads
+    eat.scrape_processes = processes
+    eat.cache_enabled = False
+    eat.dumpdest = outdir
+    eat.host_limiters.clear()
+    eat.merged_eshop_titles.clear()
+    eat.merged_eshop_index.clear()
+    t = time.perf_counter()
+    eat.get_eshop_content()
+    sec = time.perf_counter() - t
+    with open(outdir + '/contents-eshop-MERGED.xml', 'rb') as f:
+        return sec, f.read()
+
+
+if __name__ == '__main__':
+    shop = FakeShop(make_catalog(regions, titles_per_region, 1.0), latency).start()
+    shop.point_eat_at(eat)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        results = []
+        for threads, processes in ((1, 1), (4, 1), (8, 1), (16, 1), (16, 2), (16, 4), (32, 4)):
+            outdir = tmp + '/' + str(threads) + '-' + str(processes)
+            os.makedirs(outdir)
+            results.append((threads, processes) + run_scrape(threads, processes, outdir))
+    shop.stop()
+
+    print('\n')
+    print('threads   processes   seconds   speedup   same output')
+    for threads, processes, sec, merged in results:
+        print(str(threads).rjust(7), str(processes).rjust(11), ('%.2f' % sec).rjust(9), ('%.1fx' % (results[0][2] / sec)).rjust(9), str(merged == results[0][3]).rjust(13))
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+# times each stage of a full run against the fake eshop and compares with stored baselines
+#
+#   bench_stages.py [scenario ...]          run and compare with baseline.json
+#   bench_stages.py --save [scenario ...]   run and store the results as the new baseline
+
+import os
+import sys
+import io
+import json
+import time
+import argparse
+import tempfile
+import importlib
+import contextlib
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..'))
+sys.path.insert(0, here)
+import eat
+from catalog import make_catalog
+from fakeshop import FakeShop
+
+baseline_path = os.path.join(here, 'baseline.json')
+
+# regions, titles per region, share of titles sold in all regions, latency per request
+scenarios = {
+    'small': {'regions': 4, 'titles': 400, 'overlap': 0.8, 'latency': 0.01},
+    'main': {'regions': 14, 'titles': 2000, 'overlap': 0.7, 'latency': 0.02},
+    'wide': {'regions': 60, 'titles': 300, 'overlap': 0.9, 'latency': 0.02},
+}
+
+# a stage counts as a regression if it got slower than this
+regression_factor = 1.25
+
+
+def run_stages(sc, currency='EUR'):
+    # one full run in a fresh module, returns seconds per stage
+    importlib.reload(eat)
+    regions = list(eat.langs_all[0:sc['regions']])
+    shop = FakeShop(make_catalog(regions, sc['titles'], sc['overlap']), sc['latency']).start()
+    shop.point_eat_at(eat)
+    eat.langs = regions
+    eat.cache_enabled = False
+
+    stages = [('get_titlekeydb_data', eat.get_titlekeydb_data),
+              ('get_3dsdb_content', eat.get_3dsdb_content),
+              ('get_eshop_content', eat.get_eshop_content),
+              ('analyse_3dsdb', lambda: eat.analyse_3dsdb(False)),
+              ('add_eshop_prices', lambda: eat.add_eshop_prices(currency)),
+              ('build_eshop_analysis', eat.build_eshop_analysis)]
+    times = {}
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            for d in (eat.dumpdest, eat.resultdest, eat.cachedest):
+                os.makedirs(d)
+            for f in ('ctr-common-1.crt', 'ctr-common-1.key'):
+                open(f, 'w').close()
+            for name, stage in stages:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    t = time.perf_counter()
+                    stage()
+                    times[name] = round(time.perf_counter() - t, 3)
+        finally:
+            os.chdir(cwd)
+            shop.stop()
+    times['total'] = round(sum(times.values()), 3)
+    return times, sum(shop.requests.values())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("scenario", nargs="*", help="scenarios to run (default: all)")
+    parser.add_argument("--save", action="store_true", help="store the results as the new baseline")
+    args = parser.parse_args()
+
+    baseline = {}
+    if os.path.isfile(baseline_path):
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+
+    regressions = 0
+    for name in args.scenario or scenarios:
+        sc = scenarios[name]
+        times, count_req = run_stages(sc)
+        base = baseline.get(name, {}).get('seconds', {})
+
+        print('\n')
+        print(name + ': ' + str(sc['regions']) + ' regions, ' + str(sc['titles']) + ' titles per region, ' + str(count_req) + ' requests')
+        print('stage                    seconds   baseline   change')
+        for stage, sec in times.items():
+            line = stage.ljust(22) + ('%.3f' % sec).rjust(10)
+            if stage in base:
+                line += ('%.3f' % base[stage]).rjust(11) + ('%+.0f%%' % ((sec / max(base[stage], 0.001) - 1) * 100)).rjust(9)
+                if sec > base[stage] * regression_factor and sec - base[stage] > 0.05:
+                    line += '   REGRESSION'
+                    regressions += 1
+            print(line)
+
+        if args.save:
+            baseline[name] = {'scenario': sc, 'requests': count_req, 'seconds': times}
+
+    if args.save:
+        with open(baseline_path, 'w') as f:
+            json.dump(baseline, f, indent=2)
+            f.write('\n')
+
+    sys.exit(1 if regressions and not args.save else 0)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+# synthetic catalog for the benchmarks: regional listings, 3dsdb releases and titlekeys,
+# deterministic for a given seed. prices and ec info are derived from the eshop id.
+
+import random
+import string
+
+region_ids = 'AEPJKDFSIVWXYZTU'
+platform_ids = ('18', '19', '20', '103', '124', '1001', '1002')
+genres = ('Action', 'Puzzle', 'RPG', 'Sports', 'Simulation')
+
+
+def make_product(rnd, i, seen):
+    # titles of the same game id show up as alternatives in the analysis
+    while True:
+        gid = rnd.choice('ABCEKP') + ''.join(rnd.choice(string.ascii_uppercase) for _ in range(2))
+        pc = rnd.choice(('CTR', 'CTR', 'CTR', 'KTR')) + '-' + rnd.choice('NNP') + '-' + gid + rnd.choice(region_ids)
+        if not pc in seen:
+            seen.add(pc)
+            break
+    return {'pc': pc, 'eid': str(50010000000000 + i), 'tid': '00040000' + format(i, '06X') + '00', 'name': 'Title ' + str(i),
+            'platform': rnd.choice(platform_ids), 'publisher': rnd.randint(1, 200), 'genre': rnd.choice(genres)}
+
+
+def make_listing(rnd, p):
+    # per region flags, dates and ratings of a product
+    d = dict(p)
+    d['retail_sales'] = rnd.choice(('true', 'false'))
+    d['eshop_sales'] = rnd.choice(('true', 'true', 'true', 'false'))
+    d['demo'] = rnd.choice(('true', 'false'))
+    d['aoc'] = rnd.choice(('true', 'false'))
+    d['release_eshop'] = None if rnd.random() < 0.1 else '20' + str(rnd.randint(11, 20)) + '-' + format(rnd.randint(1, 12), '02') + '-' + format(rnd.randint(1, 28), '02')
+    d['release_retail'] = None if rnd.random() < 0.3 else '20' + str(rnd.randint(11, 20)) + '-' + format(rnd.randint(1, 12), '02') + '-' + format(rnd.randint(1, 28), '02')
+    d['stars'] = None
+    if rnd.random() < 0.8:
+        d['stars'] = [rnd.randint(0, 30) for _ in range(4)] + [rnd.randint(1, 30)]
+    return d
+
+
+def make_catalog(regions, titles, overlap, seed=1):
+    # every region lists the given number of titles, the overlap share of them is taken
+    # from a pool shared by all regions, the rest is only sold in that region
+    rnd = random.Random(seed)
+    seen = set()
+    shared = [make_product(rnd, i, seen) for i in range(titles)]
+    products = list(shared)
+    listings = {}
+    count_shared = int(round(titles * overlap))
+    for l in regions:
+        items = rnd.sample(shared, count_shared)
+        for i in range(titles - count_shared):
+            p = make_product(rnd, len(products), seen)
+            products.append(p)
+            items.append(p)
+        rnd.shuffle(items)
+        listings[l] = [make_listing(rnd, p) for p in items]
+
+    # half of the titles have a cart dump, plus carts that never made it to the eshop
+    releases = []
+    for p in products:
+        if rnd.random() < 0.5:
+            releases.append({'id': str(len(releases) + 1), 'serial': p['pc'][0:3] + '-' + p['pc'][6:10], 'titleid': p['tid'], 'name': p['name']})
+    for i in range(len(products) // 4):
+        serial = rnd.choice(('CTR', 'KTR')) + '-' + rnd.choice('ABCEKP') + ''.join(rnd.choice(string.ascii_uppercase) for _ in range(2)) + rnd.choice(region_ids)
+        releases.append({'id': str(len(releases) + 1), 'serial': serial, 'titleid': '000400000F' + format(i, '04X') + '00', 'name': 'Cart ' + str(i)})
+    rnd.shuffle(releases)
+
+    # half of the titles have a known titlekey
+    titlekeys = []
+    for p in products:
+        if rnd.random() < 0.5:
+            titlekeys.append({'titleID': p['tid'], 'serial': p['pc'], 'titleKey': format(rnd.getrandbits(128), '032x'), 'encTitleKey': format(rnd.getrandbits(128), '032x'),
+                              'password': None, 'name': p['name'], 'region': 'ALL', 'size': str(rnd.randint(1, 1 << 30))})
+
+    # countries with the same currency share a storefront and its prices
+    currencies = {l: rnd.choice(('USD', 'EUR', 'GBP', 'JPY')) for l in regions}
+
+    return {'regions': list(regions), 'products': products, 'listings': listings, 'releases': releases, 'titlekeys': titlekeys,
+            'currencies': currencies, 'storefronts': dict(currencies),
+            'rates': {'usd': {'code': 'USD', 'rate': 1.12}, 'gbp': {'code': 'GBP', 'rate': 0.86}, 'jpy': {'code': 'JPY', 'rate': 130.5}, 'eur': {'code': 'EUR', 'rate': 1.0}}}
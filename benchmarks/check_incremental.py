@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+# runs the scrape against a fake eshop, changes the catalog and runs again with -i on the
+# aged cache and dumps of the first run. the results must be the same as those of a full run
+# on the changed catalog, with requests only for the changed titles and listing pages.
+
+import os
+import sys
+import io
+import copy
+import json
+import glob
+import random
+import tempfile
+import importlib
+import contextlib
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..'))
+sys.path.insert(0, here)
+import eat
+from catalog import make_catalog, make_product, make_listing
+from fakeshop import FakeShop
+
+regions = ['US', 'GB', 'JP', 'DE', 'FR', 'AU']
+titles_per_region = 400
+
+# time between the runs, long enough for every cached response to be stale
+age = 8 * 24 * 3600
+
+# outputs that depend on the history of the working directory, not only on the catalog
+history_outputs = ('metrics.json', 'snapshot-eshop.json', 'enriched-eshop.json', 'price-classes.json')
+
+
+def change_catalog(catalog):
+    # a new title in a region, one title gone from another one and one release date changed
+    rnd = random.Random(2)
+    p = make_product(rnd, len(catalog['products']), set(p['pc'] for p in catalog['products']))
+    catalog['products'].append(p)
+    catalog['listings']['US'].insert(0, make_listing(rnd, p))
+    del catalog['listings']['JP'][150]
+    d = catalog['listings']['GB'][300]
+    d['release_eshop'] = '2021-01-01' if d['release_eshop'] != '2021-01-01' else '2021-01-02'
+
+
+def age_run(wd):
+    # moves the cache entries and ec info of a run back in time
+    for path in glob.glob(os.path.join(wd, eat.cachedest, '*.json')):
+        with open(path) as f:
+            meta = json.load(f)
+        meta['time'] -= age
+        with open(path, 'w') as f:
+            json.dump(meta, f)
+    path = os.path.join(wd, eat.dumpdest, 'enriched-eshop.json')
+    with open(path) as f:
+        enriched = json.load(f)
+    for e in enriched['titles'].values():
+        e['time'] -= age
+    with open(path, 'w') as f:
+        json.dump(enriched, f)
+
+
+def run(catalog, wd, incremental, port=0):
+    # full run with a fresh module in wd, returns the output files, the requests and 304
+    # answers per host and the port of the fake eshop. cached responses are only used by
+    # runs on the same port.
+    importlib.reload(eat)
+    shop = FakeShop(catalog, 0.0, port=port).start()
+    shop.point_eat_at(eat)
+    eat.langs = regions
+    eat.incremental = incremental
+
+    outputs = {}
+    cwd = os.getcwd()
+    os.makedirs(wd, exist_ok=True)
+    os.chdir(wd)
+    try:
+        for d in (eat.dumpdest, eat.resultdest, eat.cachedest):
+            os.makedirs(d, exist_ok=True)
+        for f in ('ctr-common-1.crt', 'ctr-common-1.key'):
+            open(f, 'w').close()
+        with contextlib.redirect_stdout(io.StringIO()):
+            eat.get_3dsdb_content()
+            eat.get_eshop_content()
+            eat.analyse_3dsdb(False)
+            eat.add_eshop_prices('EUR')
+            eat.save_enriched_titles('EUR')
+            eat.build_eshop_analysis()
+        for d in (eat.dumpdest, eat.resultdest):
+            for f in sorted(os.listdir(d)):
+                if not f in history_outputs and not f.startswith('changes_'):
+                    with open(d + '/' + f, 'rb') as fo:
+                        outputs[d + '/' + f] = fo.read()
+    finally:
+        os.chdir(cwd)
+        shop.stop()
+    return outputs, shop.requests, shop.not_modified, shop.server.server_address[1]
+
+
+if __name__ == '__main__':
+    catalog = make_catalog(regions, titles_per_region, 0.8)
+    changed = copy.deepcopy(catalog)
+    change_catalog(changed)
+    with tempfile.TemporaryDirectory() as tmp:
+        inc = os.path.join(tmp, 'incremental')
+        port = run(catalog, inc, False)[3]
+        age_run(inc)
+        results = [('incremental', ) + run(changed, inc, True, port), ('full', ) + run(changed, os.path.join(tmp, 'full'), False)]
+
+    print('\n')
+    print('run            listing pages   not modified   ec info   prices   same output')
+    for name, outputs, requests, not_modified, port in results:
+        same = outputs == results[1][1]
+        print(name.ljust(12), str(requests['samurai.wup.eshop.nintendo.net']).rjust(15), str(not_modified['samurai.wup.eshop.nintendo.net']).rjust(14),
+              str(requests['ninja.wup.shop.nintendo.net']).rjust(9), str(requests['api.ec.nintendo.com']).rjust(8), str(same).rjust(13))
+    sys.exit(0 if results[0][1] == results[1][1] else 1)
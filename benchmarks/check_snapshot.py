@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+# runs the scrape against a fake eshop, changes the listings and checks that the comparison
+# with the snapshot of the first run reports only real changes. moving titles around in a
+# listing must not show up as changed titles.
+
+import os
+import sys
+import io
+import csv
+import copy
+import random
+import shutil
+import tempfile
+import importlib
+import contextlib
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..'))
+sys.path.insert(0, here)
+import eat
+from catalog import make_catalog, make_product, make_listing
+from fakeshop import FakeShop
+
+regions = ['US', 'GB', 'JP', 'DE']
+titles_per_region = 300
+
+
+def insert_title(catalog):
+    # a new title at the top of every listing, shifting all others down by one
+    rnd = random.Random(2)
+    p = make_product(rnd, len(catalog['products']), set(p['pc'] for p in catalog['products']))
+    catalog['products'].append(p)
+    for l in catalog['regions']:
+        catalog['listings'][l].insert(0, make_listing(rnd, p))
+
+
+def reverse_listings(catalog):
+    for l in catalog['regions']:
+        catalog['listings'][l].reverse()
+
+
+def change_release(catalog):
+    # one real change, so the check can tell that changes are detected at all
+    d = catalog['listings'][regions[0]][5]
+    d['release_eshop'] = '2021-01-01' if d['release_eshop'] != '2021-01-01' else '2021-01-02'
+
+
+# scenario, catalog change, expected new and changed titles
+scenarios = [
+    ('unchanged', lambda catalog: None, 0, 0),
+    ('title inserted at the top', insert_title, 1, 0),
+    ('listings reversed', reverse_listings, 0, 0),
+    ('one release date changed', change_release, 0, 1),
+]
+
+
+def run(catalog, tmp):
+    # full run with a fresh module in tmp, returns the number of new and changed titles
+    importlib.reload(eat)
+    shop = FakeShop(catalog, 0.0).start()
+    shop.point_eat_at(eat)
+    eat.langs = regions
+    eat.cache_enabled = False
+
+    cwd = os.getcwd()
+    os.chdir(tmp)
+    try:
+        for d in (eat.dumpdest, eat.resultdest):
+            os.makedirs(d, exist_ok=True)
+        for f in ('ctr-common-1.crt', 'ctr-common-1.key'):
+            open(f, 'w').close()
+        with contextlib.redirect_stdout(io.StringIO()):
+            eat.get_3dsdb_content()
+            eat.get_eshop_content()
+            eat.analyse_3dsdb(False)
+            eat.add_eshop_prices('EUR')
+            eat.build_eshop_analysis()
+            eat.diff_eshop_snapshot('EUR')
+        counts = []
+        for out in (eat.csv_changes_new, eat.csv_changes_changed):
+            if not os.path.isfile(out):
+                counts.append(None)
+                continue
+            with open(out, 'r', encoding='utf-8') as f:
+                counts.append(sum(1 for _ in csv.DictReader(f)))
+        return counts
+    finally:
+        os.chdir(cwd)
+        shop.stop()
+
+
+if __name__ == '__main__':
+    catalog = make_catalog(regions, titles_per_region, 0.8)
+    with tempfile.TemporaryDirectory() as tmp:
+        first = os.path.join(tmp, 'first')
+        os.makedirs(first)
+        run(catalog, first)
+        snapshot = os.path.join(first, eat.dumpdest, 'snapshot-eshop.json')
+
+        print('\n')
+        print('scenario                     new   changed   expected')
+        failed = 0
+        for i, (name, change, new, changed) in enumerate(scenarios):
+            cat = copy.deepcopy(catalog)
+            change(cat)
+            wd = os.path.join(tmp, str(i))
+            os.makedirs(os.path.join(wd, eat.dumpdest))
+            shutil.copyfile(snapshot, os.path.join(wd, eat.dumpdest, 'snapshot-eshop.json'))
+            counts = run(cat, wd)
+            ok = counts == [new, changed]
+            failed += not ok
+            print(name.ljust(26), str(counts[0]).rjust(5), str(counts[1]).rjust(9), (str(new) + ' / ' + str(changed)).rjust(10), '' if ok else '  FAILED')
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+
+# local stand-in for the servers behind the urlbase_* endpoints, serving a synthetic catalog
+# with a fixed latency per request. faults can be injected: random server errors, throttling,
+# slow responses and a capacity above which concurrent requests are turned away. responses
+# carry an ETag, conditional requests for an unchanged response are answered with 304.
+
+import json
+import random
+import hashlib
+import threading
+import time
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+from xml.sax.saxutils import escape
+
+error_xml = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?><eshop><error><code>3010</code><message>not found</message></error></eshop>'
+
+
+def title_xml(d):
+    s = '<title id="' + d['eid'] + '"><name>' + escape(d['name']) + '</name><product_code>' + d['pc'] + '</product_code>'
+    s += '<banner_url>https://example.com/' + d['eid'] + '.jpg</banner_url>'
+    s += '<platform id="' + d['platform'] + '" device="CTR"><name>Platform</name></platform><publisher id="' + str(d['publisher']) + '"><name>Publisher ' + str(d['publisher']) + '</name></publisher>'
+    s += '<display_genre>' + d['genre'] + '</display_genre>'
+    s += '<retail_sales>' + d['retail_sales'] + '</retail_sales><eshop_sales>' + d['eshop_sales'] + '</eshop_sales><demo_available>' + d['demo'] + '</demo_available><aoc_available>' + d['aoc'] + '</aoc_available>'
+    s += '<rating_info><rating_system id="1"><name>ESRB</name></rating_system></rating_info>'
+    if d['release_eshop']:
+        s += '<release_date_on_eshop>' + d['release_eshop'] + '</release_date_on_eshop>'
+    if d['release_retail']:
+        s += '<release_date_on_retail>' + d['release_retail'] + '</release_date_on_retail>'
+    if d['stars']:
+        votes = sum(d['stars'])
+        score = round(sum((i + 1) * n for i, n in enumerate(d['stars'])) / votes, 2)
+        s += '<star_rating_info><score>' + str(score) + '</score><votes>' + str(votes) + '</votes>'
+        s += ''.join('<star' + str(i + 1) + '>' + str(n) + '</star' + str(i + 1) + '>' for i, n in enumerate(d['stars']))
+        s += '</star_rating_info>'
+    return s + '</title>'
+
+
+def price_json(catalog, eid, l):
+    # prices only depend on eshop id and storefront, so they need no storage
+    rnd = random.Random(eid + catalog['storefronts'][l])
+    if rnd.random() < 0.15:
+        return {'title_id': int(eid), 'sales_status': 'not_found'}
+    curr = catalog['currencies'][l]
+    pd = {'title_id': int(eid), 'sales_status': 'onsale', 'regular_price': {'currency': curr, 'raw_value': str(rnd.randint(1, 60)) + '.99'}}
+    if rnd.random() < 0.2:
+        pd['discount_price'] = {'currency': curr, 'raw_value': str(rnd.randint(1, 9)) + '.49'}
+    return pd
+
+
+class FakeShop:
+
+    def __init__(self, catalog, latency=0.0, error_rate=0.0, throttle_rate=0.0, slow_rate=0.0, slow_latency=0.0, capacity=None, seed=1, port=0):
+        self.catalog = catalog
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.capacity = capacity
+        self.active = 0
+        self.rnd = random.Random(seed)
+        self.requests = Counter()
+        self.not_modified = Counter()
+        self.faults = Counter()
+        self.lock = threading.Lock()
+        self.by_tid = {p['tid']: p for p in catalog['products']}
+        self.listed = {}
+        for l, li in catalog['listings'].items():
+            for d in li:
+                self.listed[(l, d['eid'])] = d
+
+        # built once, these do not change between requests
+        self.releases_xml = '<?xml version="1.0" encoding="UTF-8"?>\n<releases>' + ''.join(
+            '<release><id>' + r['id'] + '</id><name>' + escape(r['name']) + '</name><publisher>Publisher</publisher><region>EUR</region><languages>en</languages>'
+            '<serial>' + r['serial'] + '</serial><titleid>' + r['titleid'] + '</titleid><trimmedsize>' + str(int(r['id']) * 4096) + '</trimmedsize><type>1</type></release>'
+            for r in catalog['releases']) + '</releases>'
+        self.titlekeys_json = json.dumps(catalog['titlekeys'])
+        self.rates_json = json.dumps(catalog['rates'])
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), self.handler())
+        self.server.daemon_threads = True
+        self.base = 'http://127.0.0.1:' + str(self.server.server_address[1])
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def point_eat_at(self, eat):
+        # same paths, but every host is served from here
+        for name in ('urlbase_eshop', 'urlbase_title', 'urlbase_eid', 'urlbase_ec', 'urlbase_price', 'urlbase_lang', 'url_3dsdb', 'urlbase_rates'):
+            u = urlsplit(getattr(eat, name))
+            setattr(eat, name, self.base + '/' + u.netloc + u.path + ('?' + u.query if u.query else ''))
+        eat.titlekeyurl = self.base + '/titlekeys'
+
+    def fault(self):
+        # fault to inject into the next request, or None
+        with self.lock:
+            self.active += 1
+            x = self.rnd.random()
+            if self.capacity is not None and self.active > self.capacity:
+                fault = 'overloaded'
+            elif x < self.error_rate:
+                fault = 'error'
+            elif x < self.error_rate + self.throttle_rate:
+                fault = 'throttled'
+            elif x < self.error_rate + self.throttle_rate + self.slow_rate:
+                fault = 'slow'
+            else:
+                return None
+            self.faults[fault] += 1
+            return fault
+
+    def respond(self, path, query):
+        # returns (content type, body) for a request, body None for unknown paths
+        parts = path.split('/')
+        cat = self.catalog
+        if parts[1] == 'samurai.wup.eshop.nintendo.net':
+            l = parts[4]
+            listing = cat['listings'].get(l)
+            if listing is None:
+                return 'application/xml', error_xml
+            if parts[5] == 'languages':
+                return 'application/xml', '<eshop><languages><language><iso_code>en</iso_code></language></languages></eshop>'
+            if parts[5] == 'titles':
+                offs = int(query['offset'][0])
+                page = listing[offs:offs + int(query['limit'][0])]
+                body = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?><eshop><contents total="' + str(len(listing)) + '" offset="' + str(offs) + '" length="' + str(len(page)) + '">'
+                body += ''.join('<content index="' + str(offs + i + 1) + '">' + title_xml(d) + '</content>' for i, d in enumerate(page))
+                return 'application/xml', body + '</contents></eshop>'
+            if parts[5] == 'title':
+                d = self.listed.get((l, parts[6]))
+                if d is None:
+                    return 'application/xml', error_xml
+                return 'application/xml', '<?xml version="1.0" encoding="UTF-8" standalone="yes"?><eshop>' + title_xml(d) + '</eshop>'
+        if parts[1] == 'ninja.ctr.shop.nintendo.net':
+            body = '<eshop><title_id_pairs>'
+            for tid in query.get('title_id[]', []):
+                p = self.by_tid.get(tid.upper())
+                if p is not None:
+                    body += '<title_id_pair><ns_uid>' + p['eid'] + '</ns_uid><title_id>' + p['tid'] + '</title_id><type>title</type></title_id_pair>'
+            return 'application/xml', body + '</title_id_pairs></eshop>'
+        if parts[1] == 'ninja.wup.shop.nintendo.net':
+            eid = parts[6]
+            tid = '00040000' + format(int(eid) - 50010000000000, '06X') + '00'
+            return 'application/xml', '<eshop><title_ec_info><title_id>' + tid + '</title_id><content_size>' + str(int(eid) % 100000 * 4096) + '</content_size><title_version>0</title_version></title_ec_info></eshop>'
+        if parts[1] == 'api.ec.nintendo.com':
+            l = query['country'][0]
+            return 'application/json', json.dumps({'personalized': False, 'country': l, 'prices': [price_json(cat, eid, l) for eid in query['ids'][0].split(',')]})
+        if parts[1] == '3dsdb.com':
+            return 'application/xml', self.releases_xml
+        if parts[1] == 'www.floatrates.com':
+            return 'application/json', self.rates_json
+        if parts[1] == 'titlekeys':
+            return 'application/json', self.titlekeys_json
+        return 'text/plain', None
+
+    def handler(self):
+        shop = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                fault = shop.fault()
+                try:
+                    self.respond(fault)
+                finally:
+                    with shop.lock:
+                        shop.active -= 1
+
+            def respond(self, fault):
+                time.sleep(shop.latency)
+                u = urlsplit(self.path)
+                with shop.lock:
+                    shop.requests[u.path.split('/')[1]] += 1
+                code = 200
+                headers = {}
+                if fault == 'slow':
+                    time.sleep(shop.slow_latency)
+                if fault in ('error', 'overloaded'):
+                    ctype, body, code = 'text/plain', 'service unavailable', 503
+                elif fault == 'throttled':
+                    ctype, body, code = 'text/plain', 'too many requests', 429
+                    headers['Retry-After'] = '1'
+                else:
+                    ctype, body = shop.respond(u.path, parse_qs(u.query))
+                    if body is None:
+                        code = 404
+                        body = 'not found'
+                body = body.encode('utf-8')
+                if code == 200:
+                    # like many servers, the 304 does not repeat the validators
+                    etag = '"' + hashlib.md5(body).hexdigest() + '"'
+                    if self.headers.get('If-None-Match') == etag:
+                        with shop.lock:
+                            shop.not_modified[u.path.split('/')[1]] += 1
+                        code, body, headers = 304, b'', {}
+                    else:
+                        headers['ETag'] = etag
+                try:
+                    self.send_response(code)
+                    self.send_header('Content-Type', ctype)
+                    self.send_header('Content-Length', str(len(body)))
+                    for k, v in headers.items():
+                        self.send_header(k, v)
+                    self.end_headers()
+                    self.wfile.write(body)
+                except ConnectionError:
+                    # the client gave up waiting
+                    pass
+
+        return Handler
@@ -4,10 +4,23 @@ import os
 import sys
 
 import argparse
+import cProfile
+import pstats
+import re
 import requests
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
-import copy
 import csv
+import hashlib
+import json
+import random
+import shutil
+import sqlite3
+import threading
+import time
+from collections import namedtuple, deque
+from itertools import groupby
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from urllib.parse import urlsplit
 from xml.etree import ElementTree
 from typing import List
 
@@ -19,8 +32,114 @@ urlbase_eid = 'https://ninja.ctr.shop.nintendo.net/ninja/ws/titles/id_pair?title
 urlbase_ec = 'https://ninja.wup.shop.nintendo.net/ninja/ws/{lang}/title/{eshop_id}/ec_info?shop_id=4&lang=en'
 urlbase_price = 'https://api.ec.nintendo.com/v1/price?ids={eshop_id}&country={lang}&lang=en'
 urlbase_lang = 'https://samurai.wup.eshop.nintendo.net/samurai/ws/{lang}/languages'
+url_3dsdb = 'http://3dsdb.com/xml.php'
+urlbase_rates = 'http://www.floatrates.com/daily/{curr}.json'
+
+# number of parallel requests, optionally limited further per host. the limit per host
+# adapts to the server: it is halved on errors, throttling and very slow responses and
+# grows back by one per round of successful requests. host_rates optionally caps the
+# requests per second to a host.
+fetch_threads = 8
+host_limits = {}
+host_rates = {}
+host_limiters = {}
+host_limiters_lock = threading.Lock()
+slow_latency = 5.0
+
+# timeouts (connect, read) in seconds, retries and base delay for failed requests
+fetch_timeout = (10, 60)
+fetch_retries = 5
+fetch_backoff = 0.5
+
+# number of eshop ids per price request and title ids per id_pair request
+price_batch = 50
+idpair_batch = 20
+
+# in --list mode, a region's listing is paged and filtered instead of requesting every title
+# when that is cheaper. a page of titles is a larger response with more to parse, it counts
+# as this many single title requests.
+listing_page_cost = 4
+
+# countries that return identical prices are queried once per class. classes are learned
+# from countries with the same currency agreeing on at least price_min_shared titles, and
+# price_verify titles per class member are still queried to notice when they split up. the
+# checked titles change from run to run, a resumed run checks the same ones as the interrupted one.
+price_min_shared = 10
+price_verify = 2
+
+# listing pages requested ahead of the merge, per fetch thread. responses wait in memory until
+# they are merged, so this bounds them to about (scrape_ahead + 1) * fetch_threads pages.
+scrape_ahead = 2
+
+# check every listing page with the server even if its cached copy is still fresh, pages
+# that did not change are not downloaded again (304 not modified). ec info and prices of titles
+# whose merged content did not change since they were requested are taken from the last run,
+# for up to incremental_refresh seconds. every run keeps them in dumped/enriched-eshop.json.
+incremental = False
+incremental_refresh = 30 * 24 * 3600
+enriched_reused = {}
+
+# number of processes the regions are split across, each scrapes and merges its share of
+# the regions and the partial catalogs are combined in region order
+scrape_processes = 1
+shard_globals = ('langs', 'region_live', 'titlekeydb_index', 'fetch_threads', 'fetch_timeout', 'fetch_retries', 'host_limits', 'host_rates', 'cache_enabled',
+                 'incremental', 'checkpoint_enabled', 'checkpoint_cached', 'dumpdest', 'cachedest', 'checkpointdest', 'titlekeyurl',
+                 'urlbase_eshop', 'urlbase_title', 'urlbase_eid', 'urlbase_ec', 'urlbase_price', 'urlbase_lang', 'url_3dsdb', 'urlbase_rates')
+shard_totals = None
+
+# response cache, shared between runs
+cache_enabled = True
+cache_size = 1024 * 1024 * 1024
+cache_ttl_default = 24 * 3600
+
+# progress of a run is kept in checkpointdest until the run is finished, so an interrupted
+# run can be resumed without repeating any request. responses that are in the cache are only
+# listed in the checkpoint journal, the others (cache disabled, error responses) are copied.
+checkpoint_enabled = False
+checkpoint_state = None
+checkpoint_cached = set()
+
+# live or dead state of each eshop region, probed at startup and kept for region_ttl
+region_live = {}
+region_ttl = 24 * 3600
+
+# metrics of the current run, written to the results as json
+metrics_stages = {}
+metrics_endpoints = {}
+metrics_lock = threading.Lock()
+metrics_buckets = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+endpoint_patterns = {}
+
+# progress lines are redrawn at most progress_rate times a second on a terminal. otherwise
+# progress_mode is 'line' or 'json' and a line is written every progress_interval seconds.
+# None picks 'tty' or 'line' depending on stdout.
+progress_mode = None
+progress_rate = 10
+progress_interval = 30.0
+progress_width = 0
+
+# optional sqlite catalog, keeps the data of the last run queryable
+catalog = None
+catalog_schema = '''
+create table if not exists listings (region text, idx integer, product_code text, eshop_id text, content blob, primary key (region, product_code));
+create table if not exists titles (product_code text primary key, type text, gid text, serial text, eshop_id text, title_id text, name text, publisher text, publisher_id text, platform_id text, genre text, size integer, release_eshop text, release_retail text, eshop_sales integer, eshop_regions text, score text, votes integer, titlekey text);
+create table if not exists releases (id text, serial text, type text, gid text, title_id text, name text, publisher text, region text, languages text, size integer);
+create table if not exists titlekeys (title_id text, serial text, titlekey_dec text, titlekey_enc text, password text, name text, size integer);
+create table if not exists prices (currency text, eshop_id text, product_code text, best_price real, best_price_region text, primary key (currency, eshop_id));
+create index if not exists listings_pc on listings (product_code);
+create index if not exists titles_group on titles (type, gid);
+create index if not exists titles_serial on titles (serial);
+create index if not exists releases_serial on releases (serial);
+create index if not exists releases_group on releases (type, gid);
+create index if not exists titlekeys_serial on titlekeys (serial);
+create index if not exists prices_pc on prices (product_code);
+create view if not exists alternatives as select t.product_code, a.product_code as alternative, a.titlekey is not null as with_titlekey from titles t join titles a on a.type = t.type and a.gid = t.gid and substr(a.product_code, 7, 4) != substr(t.product_code, 7, 4) where a.eshop_sales;
+create view if not exists missing_3dsdb as select * from releases r where not exists (select 1 from titles t where t.product_code in (r.type || '-N-' || substr(r.serial, 5, 4), r.type || '-P-' || substr(r.serial, 5, 4)));
+'''
 
 dumpdest = 'dumped'
+cachedest = 'cache'
+checkpointdest = 'checkpoint'
 resultdest = 'results'
 
 csv_eshop_analysis = resultdest + '/' + 'eshop_analysis_all_in_one.csv'
@@ -33,9 +152,15 @@ csv_missing_downloads_only_retail = resultdest + '/' + 'missing_downloads_only_r
 csv_missing_titlekeys = resultdest + '/' + 'missing_titlekeys.csv'
 csv_missing_archive_eshop = resultdest + '/' + 'missing_archive_eshop.csv'
 csv_missing_archive_all = resultdest + '/' + 'missing_archive_all.csv'
+csv_changes_new = resultdest + '/' + 'changes_new_titles.csv'
+csv_changes_delisted = resultdest + '/' + 'changes_delisted_titles.csv'
+csv_changes_changed = resultdest + '/' + 'changes_changed_titles.csv'
+csv_changes_titlekeys = resultdest + '/' + 'changes_new_titlekeys.csv'
+csv_changes_prices = resultdest + '/' + 'changes_price_drops.csv'
 
 csv_fieldnames_eshop = ['title_id', 'product_code', 'region_id', 'name', 'publisher', 'publisher_id', 'platform', 'platform_id', 'genre', 'size', 'release_eshop', 'release_retail', 'eshop_regions', 'score', 'votes', 'best_price', 'best_price_region', 'titlekey_known', '3dsdb_id', 'alternative_download', 'alternative_with_titlekey', 'best_alternative']
 csv_fieldnames_3dsdb = ['title_id', 'product_code', 'region_id', 'name', 'publisher', 'region', 'languages', 'size', '3dsdb_id', 'alternative_download', 'alternative_with_titlekey', 'best_alternative']
+csv_fieldnames_changes = ['product_code', 'eshop_id', 'name', 'eshop_regions', 'delisted_regions', 'changed_fields', 'previous_price', 'previous_price_region', 'best_price', 'best_price_region']
 csv_fieldnames_titlekeys = ['title_id', 'product_code', 'titlekey_dec', 'titlekey_enc', 'password', 'name', 'region', 'size']
 
 langs_english = ('US', 'GB', 'CA', 'AU')
@@ -46,9 +171,125 @@ platform_dict = {'18' : 'Nintendo 3DS Retail Only', '19' : 'Nintendo 3DS Downloa
 
 region_id_pref = {'A' : 0, 'P' : 1, 'E' : 2, 'J' : 3, 'S' : 4, 'D' : 5, 'F' : 6, 'I' : 7, 'H' : 8, 'R' : 9, 'W' : 10, 'K' : 11, 'V' : 12, 'X' : 13, 'Y' : 14, 'Z' : 15, 'T' : 16, 'O' : 17, 'U' : 18}
 
-merged_eshop_elements = []
+# compact 3dsdb release record, only the fields used by the analysis
+DbRelease = namedtuple('DbRelease', ['id', 'serial', 'titleid', 'name', 'publisher', 'region', 'languages', 'trimmedsize'])
+
+# merged eshop title, keeps the fields used by the analysis parsed and the rest of
+# the content XML serialized, the XML is only rebuilt when dumping
+class EshopTitle:
+    __slots__ = ('index', 'eshop_id', 'product_code', 'name', 'platform_id', 'publisher', 'publisher_id', 'genre',
+                 'retail_sales', 'eshop_sales', 'demo_available', 'aoc_available', 'release_eshop', 'release_retail',
+                 'score', 'stars', 'regions', 'titlekey', 'ec_info', 'ec_title_id', 'ec_size', 'p_best', 'p_region', 'xml', 'tail')
+
+    def __init__(self, cn, pc):
+        tt = cn.find('title')
+        self.index = int(cn.get('index'))
+        self.eshop_id = tt.get('id')
+        self.product_code = pc
+        self.name = tt.findtext('name')
+        self.platform_id = tt.find('platform').get('id')
+        self.publisher = tt.find('publisher').findtext('name')
+        self.publisher_id = tt.find('publisher').get('id')
+        self.genre = tt.findtext('display_genre')
+        self.retail_sales = tt.findtext('retail_sales') == 'true'
+        self.eshop_sales = tt.findtext('eshop_sales') == 'true'
+        self.demo_available = tt.findtext('demo_available') == 'true'
+        self.aoc_available = tt.findtext('aoc_available') == 'true'
+        self.release_eshop = tt.findtext('release_date_on_eshop')
+        self.release_retail = tt.findtext('release_date_on_retail')
+        self.score = None
+        self.stars = None
+        sr = tt.find('star_rating_info')
+        if sr is not None:
+            self.score = sr.findtext('score')
+            self.stars = [int(sr.findtext(st)) for st in ('votes', 'star1', 'star2', 'star3', 'star4', 'star5')]
+        self.regions = 0
+        self.titlekey = None
+        self.ec_info = None
+        self.ec_title_id = ''
+        self.ec_size = '0'
+        self.p_best = None
+        self.p_region = None
+
+        # keep the content XML without unneeded stuff, without touching the original element
+        cncp = ElementTree.Element(cn.tag, cn.attrib)
+        cncp.text = cn.text
+        for ee in cn:
+            if ee is tt:
+                ttcp = ElementTree.SubElement(cncp, tt.tag, tt.attrib)
+                ttcp.text = tt.text
+                ttcp.tail = tt.tail
+                ttcp.extend(e for e in tt if e.tag not in ('rating_info', 'price_on_retail', 'price_on_retail_detail', 'tentative_price_on_eshop', 'banner_url'))
+            else:
+                cncp.append(ee)
+        self.xml = ElementTree.tostring(cncp)
+        self.tail = cn.tail
+
+    def set_ec_info(self, ec):
+        self.ec_info = ElementTree.tostring(ec)
+        self.ec_title_id = ec.findtext('title_id')
+        if ec.find('content_size') is not None:
+            self.ec_size = ec.findtext('content_size')
+
+    def to_element(self):
+        # rebuild the content element for the dump
+        cn = ElementTree.fromstring(self.xml)
+        cn.tail = self.tail
+        tt = cn.find('title')
+        for tag in ('retail_sales', 'eshop_sales', 'demo_available', 'aoc_available'):
+            if getattr(self, tag):
+                tt.find(tag).text = 'true'
+        if self.release_eshop is not None:
+            tt.find('release_date_on_eshop').text = self.release_eshop
+        if self.release_retail is not None:
+            tt.find('release_date_on_retail').text = self.release_retail
+        if self.stars is not None:
+            sr = tt.find('star_rating_info')
+            for tag, st in zip(('votes', 'star1', 'star2', 'star3', 'star4', 'star5'), self.stars):
+                sr.find(tag).text = str(st)
+            sr.find('score').text = self.score
+        if self.ec_info is not None:
+            cn.insert(1, ElementTree.fromstring(self.ec_info))
+
+        # add eshop_regions and titlekey
+        sel = ElementTree.SubElement(cn, 'eshop_regions')
+        for i, lng in enumerate(langs):
+            cur = ElementTree.SubElement(sel, lng)
+            cur.text = 'false'
+            if self.regions >> i & 1:
+                cur.text = 'true'
+        sel = ElementTree.SubElement(cn, 'dectitlekey')
+        sel.text = self.titlekey
+        return cn
+
+
+merged_eshop_titles = []
+region_bits = {}
+region_bits_langs = None
+merged_eshop_index = {}
+merged_eshop_groups = {}
 db_release_elements = []
+db_release_index = {}
+missing_3dsdb_rows = []
 titlekeydb_data = []
+titlekeydb_index = {}
+
+
+def region_bit(l):
+    # regions of a title are kept as a bitmask, bit i is set if the title is available in langs[i]
+    global region_bits, region_bits_langs
+    if region_bits_langs is not langs:
+        region_bits = {lng: 1 << i for i, lng in enumerate(langs)}
+        region_bits_langs = langs
+    return region_bits[l]
+
+
+def region_list(regions):
+    # regions in a bitmask, in langs order
+    while regions:
+        low = regions & -regions
+        yield langs[low.bit_length() - 1]
+        regions ^= low
 
 
 def write_eshop_content(el, out):
@@ -69,444 +310,1518 @@ def write_eshop_content(el, out):
     merged.write(out)
     
 
-def is_eshop_available(lang):
+def eshop_session(cert=False):
+    # session with a connection pool big enough for all worker threads
+    requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
+    s = requests.session()
+    s.verify = False
+    if cert:
+        s.cert = ('ctr-common-1.crt', 'ctr-common-1.key')
+    adapter = requests.adapters.HTTPAdapter(pool_connections=fetch_threads, pool_maxsize=fetch_threads)
+    s.mount('http://', adapter)
+    s.mount('https://', adapter)
+    return s
+
+
+class HostLimiter:
+    # concurrency limit for one host, used as a context manager around a request
+
+    def __init__(self, limit, rate):
+        self.max_limit = limit
+        self.limit = float(limit)
+        self.active = 0
+        self.interval = 1.0 / rate if rate else 0.0
+        self.next_start = 0.0
+        self.min_latency = None
+        self.avg_latency = 0.0
+        self.last_decrease = 0.0
+        self.cond = threading.Condition()
+
+    def __enter__(self):
+        with self.cond:
+            while self.active >= int(self.limit):
+                self.cond.wait()
+            self.active += 1
+            # with a rate limit, requests are started at least interval seconds apart
+            now = time.monotonic()
+            start = max(now, self.next_start)
+            self.next_start = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+        return self
+
+    def __exit__(self, *exc):
+        with self.cond:
+            self.active -= 1
+            self.cond.notify()
+
+    def success(self, latency):
+        with self.cond:
+            if self.min_latency is None or latency < self.min_latency:
+                self.min_latency = latency
+            self.avg_latency = 0.8 * self.avg_latency + 0.2 * latency
+            if latency > max(slow_latency, 4 * self.min_latency):
+                self.decrease()
+            elif self.limit < self.max_limit:
+                self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+                self.cond.notify_all()
+
+    def failure(self):
+        with self.cond:
+            self.decrease()
+
+    def decrease(self):
+        # at most once per round trip, the requests in flight failing together count as one
+        now = time.monotonic()
+        if now - self.last_decrease >= self.avg_latency:
+            self.limit = max(1.0, self.limit / 2)
+            self.last_decrease = now
+
+
+def host_limiter(url):
+    host = urlsplit(url).hostname
+    with host_limiters_lock:
+        if host not in host_limiters:
+            host_limiters[host] = HostLimiter(host_limits.get(host, fetch_threads), host_rates.get(host))
+        return host_limiters[host]
+
+
+def cache_ttl(url):
+    # seconds a cached response stays fresh, by endpoint
+    ttls = ((urlbase_eshop, 12 * 3600), (urlbase_title, 12 * 3600), (urlbase_lang, 12 * 3600), (urlbase_eid, 7 * 24 * 3600), (urlbase_ec, 7 * 24 * 3600), (urlbase_price, 3600), (urlbase_rates, 6 * 3600), (url_3dsdb, 24 * 3600))
+    for urlbase, ttl in ttls:
+        if url.startswith(urlbase.split('{')[0]):
+            return ttl
+    return cache_ttl_default
+
+
+def cache_path(url):
+    return cachedest + '/' + hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+
+def cache_lookup(path):
+    # cache meta data or None, the meta file is written last so its presence marks a complete entry
+    try:
+        with open(path + '.json', 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def cache_write(path, data):
+    tmp = path + '.' + str(os.getpid()) + '.' + str(threading.get_ident())
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def cache_store(path, url, r, prev=None):
+    # a 304 may leave out the validators, those of the revalidated entry are kept then
+    meta = {'url': url, 'time': time.time(), 'etag': r.headers.get('ETag'), 'last_modified': r.headers.get('Last-Modified')}
+    if prev is not None:
+        meta['etag'] = meta['etag'] or prev['etag']
+        meta['last_modified'] = meta['last_modified'] or prev['last_modified']
+    cache_write(path + '.json', json.dumps(meta).encode('utf-8'))
+
+
+def cache_load(path, out):
+    # mark as recently used for eviction
+    os.utime(path)
+    if out is not None:
+        shutil.copyfile(path, out)
+        return None
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def prune_cache():
+    # evict least recently used responses until the cache fits into cache_size
+    if not os.path.isdir(cachedest):
+        return
+    entries = []
+    for e in os.scandir(cachedest):
+        if e.is_file() and not e.name.endswith('.json'):
+            st = e.stat()
+            entries.append((st.st_mtime, st.st_size, e.path))
+    entries.sort()
+    size = sum(e[1] for e in entries)
+    for mtime, esize, path in entries:
+        if size <= cache_size:
+            break
+        for p in (path + '.json', path):
+            try:
+                os.remove(p)
+            except FileNotFoundError:
+                pass
+        size -= esize
+
+
+def endpoint_name(url):
+    # endpoint family of url for the metrics
+    endpoints = ((urlbase_eshop, 'samurai titles'), (urlbase_title, 'samurai title'), (urlbase_lang, 'languages'), (urlbase_eid, 'id_pair'), (urlbase_ec, 'ec_info'), (urlbase_price, 'price'), (urlbase_rates, 'floatrates'), (url_3dsdb, '3dsdb'))
+    for urlbase, name in endpoints:
+        if urlbase not in endpoint_patterns:
+            endpoint_patterns[urlbase] = re.compile(re.sub(r'\\\{\w+\\\}', '.*', re.escape(urlbase)))
+        if endpoint_patterns[urlbase].fullmatch(url):
+            return name
+    if titlekeyurl and url.startswith(titlekeyurl):
+        return 'titlekey'
+    return urlsplit(url).hostname
+
+
+def endpoint_metrics(name):
+    # call with metrics_lock held
+    if name not in metrics_endpoints:
+        metrics_endpoints[name] = {'requests': 0, 'cached': 0, 'resumed': 0, 'not_modified': 0, 'retries': 0, 'errors': 0, 'bytes': 0, 'seconds': 0.0, 'max_ms': 0.0,
+                                   'latency_ms': {str(b): 0 for b in metrics_buckets + ('inf', )}, 'parse_seconds': 0.0}
+    return metrics_endpoints[name]
+
+
+def record_request(url, t_start, size):
+    # a request that went to the server, latency from t_start (perf_counter)
+    sec = time.perf_counter() - t_start
+    ms = sec * 1000
+    bucket = next((str(b) for b in metrics_buckets if ms <= b), 'inf')
+    with metrics_lock:
+        m = endpoint_metrics(endpoint_name(url))
+        m['requests'] += 1
+        m['bytes'] += size
+        m['seconds'] += sec
+        m['max_ms'] = max(m['max_ms'], round(ms, 1))
+        m['latency_ms'][bucket] += 1
+
+
+def record_event(url, key):
+    # cached, not_modified, retries or errors
+    with metrics_lock:
+        endpoint_metrics(endpoint_name(url))[key] += 1
+
+
+def record_parse(name, t_start):
+    with metrics_lock:
+        endpoint_metrics(name)['parse_seconds'] += time.perf_counter() - t_start
+
+
+def progress_output():
+    global progress_mode
+    if progress_mode is None:
+        progress_mode = 'tty' if sys.stdout.isatty() else 'line'
+    return progress_mode
+
+
+def show_line(line, final):
+    # on a terminal, a progress line is overwritten by the next one
+    global progress_width
+    if progress_output() == 'tty':
+        print(line.ljust(progress_width), end = '\n' if final else '\r', flush = not final)
+        progress_width = 0 if final else len(line)
+    else:
+        print(line, flush=True)
+
+
+def show_status(line):
+    # one-off status line
+    if progress_output() == 'json':
+        print(json.dumps({'message': line}), flush=True)
+    else:
+        show_line(line, True)
+
+
+class Progress:
+    # progress of a loop, shown at a bounded rate with items/sec and an eta once the total is known.
+    # the note is only formatted when a line is shown.
+
+    def __init__(self, label, total=None, unit='entries', note=None):
+        self.label = label
+        self.total = total
+        self.unit = unit
+        self.note = note
+        self.args = ()
+        self.count = 0
+        self.t_start = time.perf_counter()
+        self.t_shown = self.t_start
+        self.interval = 1 / progress_rate if progress_output() == 'tty' else progress_interval
+        if progress_output() == 'tty':
+            show_line(label + ': ...', False)
+
+    def update(self, count, *args):
+        self.count = count
+        self.args = args
+        t = time.perf_counter()
+        if t - self.t_shown >= self.interval:
+            self.t_shown = t
+            self.show(t)
+
+    def show(self, t):
+        rate = self.count / max(t - self.t_start, 0.001)
+        eta = None
+        if self.total is not None and rate > 0 and self.count < self.total:
+            eta = (self.total - self.count) / rate
+        if progress_output() == 'json':
+            print(json.dumps({'stage': self.label, 'count': self.count, 'total': self.total, 'rate': round(rate, 1), 'eta': None if eta is None else round(eta)}), flush=True)
+            return
+        line = self.label + ': ' + str(self.count)
+        if self.total is not None:
+            line += ' / ' + str(self.total)
+        line += ' ' + self.unit
+        if self.note is not None:
+            line += ' (' + self.note.format(*self.args) + ')'
+        line += ', ' + str(round(rate, 1)) + ' ' + self.unit + '/sec'
+        if eta is not None:
+            line += ', ETA ' + str(int(eta // 60)) + ':' + format(int(eta % 60), '02')
+        show_line(line, False)
+
+    def done(self, line, count=None):
+        # the final line is always shown
+        if count is not None:
+            self.count = count
+        if progress_output() == 'json':
+            sec = time.perf_counter() - self.t_start
+            print(json.dumps({'stage': self.label, 'count': self.count, 'total': self.total, 'seconds': round(sec, 2), 'rate': round(self.count / max(sec, 0.001), 1), 'message': line}), flush=True)
+        else:
+            show_line(line, True)
+
+
+def run_stage(name, stage, *args):
+    t_start = time.perf_counter()
+    result = stage(*args)
+    metrics_stages[name] = metrics_stages.get(name, 0.0) + time.perf_counter() - t_start
+    if checkpoint_enabled:
+        checkpoint_state['stages'].append(name)
+        write_checkpoint_state()
+    return result
+
+
+def write_checkpoint_state():
+    tmp = checkpointdest + '/state.json.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(checkpoint_state, f)
+    os.replace(tmp, checkpointdest + '/state.json')
+
+
+def start_checkpoint(options, resume):
+    # a resumed run replays the stages of the interrupted one from its responses, anything
+    # else starts with an empty checkpoint
+    global checkpoint_enabled, checkpoint_state
+    checkpoint_cached.clear()
+    state = None
+    if resume:
+        try:
+            with open(checkpointdest + '/state.json', 'r') as f:
+                state = json.load(f)
+        except (FileNotFoundError, ValueError):
+            show_status('Resuming: no checkpoint found, starting over')
+        if state is not None and state['options'] != options:
+            show_status('Resuming: checkpoint is from a run with other options, starting over')
+            state = None
+    if state is None:
+        shutil.rmtree(checkpointdest, ignore_errors=True)
+        os.makedirs(checkpointdest)
+    else:
+        try:
+            with open(checkpointdest + '/cached', 'r') as f:
+                checkpoint_cached.update(line.strip() for line in f if len(line.strip()) == 40)
+        except FileNotFoundError:
+            pass
+        count_resp = len(checkpoint_cached) + sum(1 for e in os.scandir(checkpointdest) if len(e.name) == 40)
+        show_status('Resuming run from ' + state['time'] + ': ' + str(len(state['stages'])) + ' stages and ' + str(count_resp) + ' responses done')
+    checkpoint_state = {'time': state['time'] if state else time.strftime('%Y-%m-%dT%H:%M:%S'), 'options': options, 'stages': []}
+    checkpoint_enabled = True
+    write_checkpoint_state()
+
+
+def journal_cached(path):
+    # the response at cache path is complete, a resumed run can take it from the cache
+    key = os.path.basename(path)
+    if checkpoint_enabled and key not in checkpoint_cached:
+        checkpoint_cached.add(key)
+        with open(checkpointdest + '/cached', 'a') as f:
+            f.write(key + '\n')
+
+
+def finish_checkpoint():
+    global checkpoint_enabled
+    checkpoint_enabled = False
+    shutil.rmtree(checkpointdest, ignore_errors=True)
+
+
+def write_metrics_report(out, wall):
+    stages = {name: round(sec, 3) for name, sec in metrics_stages.items()}
+    endpoints = {}
+    for name, m in sorted(metrics_endpoints.items()):
+        endpoints[name] = dict(m, seconds=round(m['seconds'], 3), parse_seconds=round(m['parse_seconds'], 3))
+    report = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'wall_seconds': round(wall, 3), 'regions': len(langs), 'workers': fetch_threads, 'titles': len(merged_eshop_titles),
+              'stages': stages, 'endpoints': endpoints}
+    with open(out, 'w') as f:
+        json.dump(report, f, indent=2)
+        f.write('\n')
+
+
+def retry_after(r):
+    # seconds from a Retry-After header, 0 if there is none
+    try:
+        return float(r.headers.get('Retry-After', 0))
+    except ValueError:
+        return 0
+
+
+def fetch(s, url, retries=None, out=None, revalidate=False):
+    # get url, from the checkpoint of an interrupted run if it was fetched there already.
+    # cached responses of the interrupted run are taken from the cache even if they are stale.
+    if not checkpoint_enabled:
+        return fetch_url(s, url, retries, out, revalidate)
+    key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+    path = checkpointdest + '/' + key
+    if os.path.isfile(path):
+        record_event(url, 'resumed')
+        if out is not None:
+            shutil.copyfile(path, out)
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+    if cache_enabled and key in checkpoint_cached and cache_lookup(cache_path(url)) is not None:
+        record_event(url, 'resumed')
+        return cache_load(cache_path(url), out)
+
+    checkpoint_cached.discard(key)
+    data = fetch_url(s, url, retries, out, revalidate)
+    if key in checkpoint_cached:
+        return data
+    if out is not None:
+        tmp = path + '.' + str(os.getpid()) + '.' + str(threading.get_ident())
+        shutil.copyfile(out, tmp)
+        os.replace(tmp, path)
+    else:
+        cache_write(path, data)
+    return data
+
+
+def fetch_url(s, url, retries=None, out=None, revalidate=False):
+    # get url through the response cache, retry on connection errors, timeouts, server errors
+    # and throttling with jittered exponential backoff. if out is given, the response is
+    # streamed to that file. with revalidate, cached entries are checked with the server even
+    # if they are still fresh.
+    if retries is None:
+        retries = fetch_retries
+    path = cache_path(url) if cache_enabled else None
+    meta = cache_lookup(path) if path else None
+    if meta is not None and not revalidate and time.time() - meta['time'] < cache_ttl(url):
+        record_event(url, 'cached')
+        journal_cached(path)
+        return cache_load(path, out)
+
+    # revalidate stale entries
+    headers = {}
+    if meta is not None and meta['etag']:
+        headers['If-None-Match'] = meta['etag']
+    if meta is not None and meta['last_modified']:
+        headers['If-Modified-Since'] = meta['last_modified']
+
+    limiter = host_limiter(url)
+    for attempt in range(retries + 1):
+        delay = fetch_backoff * (2 ** attempt)
+        delay = delay / 2 + random.uniform(0, delay / 2)
+        try:
+            with limiter:
+                t_start = time.perf_counter()
+                with s.get(url, headers=headers, stream=out is not None, timeout=fetch_timeout) as r:
+                    if r.status_code == 304 and meta is not None:
+                        limiter.success(time.perf_counter() - t_start)
+                        record_request(url, t_start, 0)
+                        record_event(url, 'not_modified')
+                        cache_store(path, url, r, meta)
+                        journal_cached(path)
+                        return cache_load(path, out)
+                    if r.status_code < 500 and r.status_code != 429:
+                        cache = path is not None and r.status_code == 200
+                        if out is None:
+                            limiter.success(time.perf_counter() - t_start)
+                            record_request(url, t_start, len(r.content))
+                            if cache:
+                                cache_write(path, r.content)
+                                cache_store(path, url, r)
+                                journal_cached(path)
+                            return r.content
+                        size = 0
+                        with open(out, 'wb') as f:
+                            for chunk in r.iter_content(chunk_size=65536):
+                                f.write(chunk)
+                                size += len(chunk)
+                        limiter.success(time.perf_counter() - t_start)
+                        record_request(url, t_start, size)
+                        if cache:
+                            shutil.copyfile(out, path)
+                            cache_store(path, url, r)
+                            journal_cached(path)
+                        return None
+
+                    # server error or throttled
+                    limiter.failure()
+                    record_request(url, t_start, len(r.content))
+                    record_event(url, 'errors')
+                    delay = max(delay, retry_after(r))
+                    status = r.status_code
+        except requests.exceptions.RequestException:
+            limiter.failure()
+            record_event(url, 'errors')
+            if attempt == retries:
+                raise
+        else:
+            if attempt == retries:
+                raise requests.exceptions.HTTPError(str(status) + ' Server Error for url: ' + url)
+        record_event(url, 'retries')
+        time.sleep(delay)
+
+
+def write_merged_content(out):
+    # sort data
+    merged_eshop_titles.sort(key=lambda x: x.index)
+    if len(merged_eshop_titles) == 0:
+        write_eshop_content([], out)
+        return
+
+    # generate merged XML one title at a time, same output as write_eshop_content
+    with open(out, 'wb') as f:
+        f.write(b'<contents contents="' + str(len(merged_eshop_titles)).encode('ascii') + b'">')
+        for et in merged_eshop_titles:
+            f.write(ElementTree.tostring(et.to_element()))
+        f.write(b'</contents>')
+
+
+def is_eshop_available(s, lang):
     av = True
     
     # check availability of eshop
-    requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
-    with requests.session() as s:
-        s.verify = False
-        url = urlbase_lang.format(lang=lang)
-        with s.get(url) as r:
-            el = ElementTree.fromstring(r.content)
-            er = el.find('error')
-            if er is not None:
-                av = False
-                
+    url = urlbase_lang.format(lang=lang)
+    data = fetch(s, url)
+    t_start = time.perf_counter()
+    el = ElementTree.fromstring(data)
+    record_parse('languages', t_start)
+    er = el.find('error')
+    if er is not None:
+        av = False
+
     return(av)
 
 
+def probe_regions():
+    # check all regions at once, results of earlier runs are reused for region_ttl
+    path = cachedest + '/regions.json'
+    status = {}
+    if cache_enabled:
+        try:
+            with open(path, 'r') as f:
+                status = json.load(f)
+        except (FileNotFoundError, ValueError):
+            pass
+
+    now = time.time()
+    stale = [l for l in langs if not l in status or now - status[l]['time'] >= region_ttl]
+    progress = Progress('Probing eshop regions', len(stale), 'regions')
+    with eshop_session() as s, ThreadPoolExecutor(max_workers=fetch_threads) as ex:
+        probes = {l: ex.submit(is_eshop_available, s, l) for l in stale}
+        for i, (l, fp) in enumerate(probes.items()):
+            progress.update(i)
+            try:
+                status[l] = {'live': fp.result(), 'time': now}
+            except requests.exceptions.RequestException:
+                # unknown, try the region anyway and probe again next run
+                status.pop(l, None)
+
+    region_live.clear()
+    for l in langs:
+        region_live[l] = status[l]['live'] if l in status else True
+    with open(path, 'w') as f:
+        json.dump(status, f)
+
+    count_live = sum(1 for l in langs if region_live[l])
+    progress.done('Probing eshop regions: ' + str(count_live) + ' / ' + str(len(langs)) + ' live (' + str(len(langs) - len(stale)) + ' cached)', len(stale))
+
+
+def live_langs():
+    # regions to fetch, dead ones are skipped without any requests
+    return [l for l in langs if region_live.get(l, True)]
+
+
+def get_eshop_ec_info(s, lng, eid):
+    url = urlbase_ec.format(lang=lng, eshop_id=eid)
+    data = fetch(s, url)
+    t_start = time.perf_counter()
+    el = ElementTree.fromstring(data)
+    record_parse('ec_info', t_start)
+    return list(el)[0]
+
+
+def enriched_hash(et):
+    # hash of the merged content of a title, without its position in the listings
+    h = hashlib.sha1(snapshot_content(et.xml))
+    h.update(repr((et.regions, et.retail_sales, et.eshop_sales, et.demo_available, et.aoc_available, et.release_eshop, et.release_retail, et.stars)).encode('utf-8'))
+    return h.hexdigest()
+
+
+def load_enriched_titles():
+    # ec info and prices of the last run for the titles that did not change since. they are
+    # requested again after incremental_refresh at the latest, spread over its second half so
+    # that titles first requested in the same run are not all requested again in the same run.
+    enriched_reused.clear()
+    path = dumpdest + '/enriched-eshop.json'
+    if not incremental or not os.path.isfile(path):
+        return
+    with open(path, 'r') as f:
+        prev = json.load(f)
+    now = time.time()
+    for et in merged_eshop_titles:
+        e = prev['titles'].get(et.eshop_id)
+        if e is None or now - e['time'] > incremental_refresh * (0.5 + int(et.eshop_id) % 100 / 200):
+            continue
+        if e['hash'] == enriched_hash(et):
+            enriched_reused[et.eshop_id] = e
+
+
+def save_enriched_titles(currency):
+    # ec info and prices of this run, entries of titles that are not part of it are kept
+    # until they are too old to be reused
+    if not os.path.isfile('ctr-common-1.crt') or not os.path.isfile('ctr-common-1.key'):
+        return
+    path = dumpdest + '/enriched-eshop.json'
+    titles = {}
+    now = time.time()
+    if os.path.isfile(path):
+        with open(path, 'r') as f:
+            titles = {eid: e for eid, e in json.load(f)['titles'].items() if now - e['time'] <= incremental_refresh}
+    for et in merged_eshop_titles:
+        e = enriched_reused.get(et.eshop_id)
+        titles[et.eshop_id] = {'hash': enriched_hash(et), 'time': e['time'] if e is not None else now, 'ec_info': et.ec_info.decode('utf-8') if et.ec_info else None,
+                               'currency': currency.upper() if currency else None, 'p_best': et.p_best, 'p_region': et.p_region}
+    with open(path + '.part', 'w') as f:
+        json.dump({'titles': titles}, f)
+    os.replace(path + '.part', path)
+
+
 def add_eshop_ec_info():
     # certificate available
     if not os.path.isfile('ctr-common-1.crt') or not os.path.isfile('ctr-common-1.key'):
         return
 
     # only continue if certs are available
-    with requests.session() as s:
-        s.verify=False
-        s.cert=('ctr-common-1.crt', 'ctr-common-1.key')
-        
-        count_all = len(merged_eshop_elements)
-        count_ok = 0
-        for cn in merged_eshop_elements:
-            eid = cn.find('title').get('id')
-            lng = 'US'
-            er = cn.find('eshop_regions')
-            for l in langs:
-                if er.find(l).text == 'true':
-                    lng = l
-                    break
+    load_enriched_titles()
+    with eshop_session(cert=True) as s, ThreadPoolExecutor(max_workers=fetch_threads) as ex:
+        t_start = time.monotonic()
+        ec_infos = []
+        count_req = 0
+        for et in merged_eshop_titles:
+            eid = et.eshop_id
+            e = enriched_reused.get(eid)
+            if e is not None and e['ec_info'] is not None:
+                ec_infos.append(ElementTree.fromstring(e['ec_info']))
+                continue
+            lng = next(region_list(et.regions), 'US')
+            ec_infos.append(ex.submit(get_eshop_ec_info, s, lng, eid))
+            count_req += 1
 
-            url = urlbase_ec.format(lang=lng, eshop_id=eid)
-            with s.get(url) as r:
-                el = ElementTree.fromstring(r.content)
-                data_root = list(el)[0]
-                cn.insert(1, data_root)
+        # attach results in the original order
+        count_all = len(merged_eshop_titles)
+        count_ok = 0
+        progress = Progress('Adding eshop ecommerce info', count_all)
+        for et, fe in zip(merged_eshop_titles, ec_infos):
+            et.set_ec_info(fe if ElementTree.iselement(fe) else fe.result())
 
             count_ok += 1
-            print('Adding eshop ecommerce info: ' + str(count_ok) + ' / ' + str(count_all) + ' entries', end = '\r')
+            progress.update(count_ok)
 
-        print('Adding eshop ecommerce info: ' + str(count_ok) + ' / ' + str(count_all) + ' entries', end = '\n')
+        rate = count_req / max(time.monotonic() - t_start, 0.001)
+        reused = ', ' + str(count_all - count_req) + ' unchanged since the last run' if incremental else ''
+        progress.done('Adding eshop ecommerce info: ' + str(count_ok) + ' / ' + str(count_all) + ' entries (' + str(count_req) + ' requests, ' + str(round(rate, 1)) + ' requests/sec' + reused + ')')
         
         
+def get_eshop_prices(s, l, eids):
+    # price info for a batch of eshop ids in one country, keyed by eshop id
+    url = urlbase_price.format(eshop_id=','.join(eids), lang=l)
+    data = fetch(s, url)
+    t_start = time.perf_counter()
+    pdata = json.loads(data)
+    record_parse('price', t_start)
+    prices = {}
+    for pd in pdata.get('prices', []):
+        if 'title_id' in pd:
+            prices[str(pd['title_id'])] = pd
+    return prices
+
+
+def best_eshop_price(eid, regions, prices, rates):
+    # lowest price over all regions, converted with the exchange rates
+    p_best = 999999999.0
+    p_region = 'none'
+    for l in region_list(regions):
+        pd = prices.get((eid, l))
+        if pd is None:
+            continue
+        if not 'sales_status' in pd or pd['sales_status'] != 'onsale':
+            continue
+        if not 'regular_price' in pd:
+            continue
+        price = None
+        if 'discount_price' in pd:
+            price = pd['discount_price']
+        else:
+            price = pd['regular_price']
+        curr = price['currency']
+        if not curr in rates:
+            continue
+        p_best_this = float(price['raw_value']) / rates[curr]
+        if p_best_this < p_best:
+            p_best = p_best_this
+            p_region = l
+    return str(round(p_best, 2)), p_region
+
+
+def load_price_classes():
+    try:
+        with open(dumpdest + '/price-classes.json', 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return []
+
+
+def plan_eshop_prices(country_eids, classes):
+    # eids to query per country, with one country per class answering for the others.
+    # returns the queries, the country each fanned out price is taken from and the
+    # checks of class members as (eid, member, source)
+    seed = checkpoint_state['time'] if checkpoint_state else ''
+    queries = {}
+    sources = {}
+    checks = []
+    for cl in classes:
+        members = [l for l in cl if country_eids.get(l)]
+        if len(members) < 2:
+            continue
+        # the member listing the most titles is asked first, the others only for titles it lacks
+        members.sort(key=lambda l: len(country_eids[l]), reverse=True)
+        owner = {}
+        for l in members:
+            queries[l] = []
+            for eid in country_eids[l]:
+                if eid in owner:
+                    sources[(eid, l)] = owner[eid]
+                else:
+                    owner[eid] = l
+                    queries[l].append(eid)
+        for l in members[1:]:
+            shared = [eid for eid in country_eids[l] if owner[eid] != l]
+            for eid in random.Random(seed + l).sample(shared, min(price_verify, len(shared))):
+                queries[l].append(eid)
+                checks.append((eid, l, sources.pop((eid, l))))
+    for l, eids in country_eids.items():
+        if not l in queries:
+            queries[l] = list(eids)
+    return queries, sources, checks
+
+
+def query_eshop_prices(s, ex, queries, prices):
+    # batches of ids per request and countries in parallel
+    batches = []
+    for l in langs:
+        eids = queries.get(l, [])
+        for i in range(0, len(eids), price_batch):
+            batches.append((l, ex.submit(get_eshop_prices, s, l, eids[i:i + price_batch])))
+
+    count_all = len(batches)
+    count_ok = 0
+    progress = Progress('Adding eshop prices', count_all, 'requests')
+    for l, fp in batches:
+        for eid, pd in fp.result().items():
+            prices[(eid, l)] = pd
+        count_ok += 1
+        progress.update(count_ok)
+    return count_all
+
+
+def learn_price_classes(classes, country_eids, prices, known, failed):
+    # countries queried for all their titles (known) are compared with each other, those with the
+    # same currency and identical prices on enough shared titles join a class. members failing
+    # their checks leave their class.
+    parent = {}
+
+    def find(l):
+        while parent.setdefault(l, l) != l:
+            l = parent[l]
+        return l
+
+    for cl in classes:
+        cl = [l for l in cl if not l in failed]
+        for l in cl[1:]:
+            parent[find(l)] = find(cl[0])
+
+    by_currency = {}
+    for l in known:
+        curr = next((prices[(eid, l)]['regular_price']['currency'] for eid in country_eids[l] if 'regular_price' in prices.get((eid, l), {})), None)
+        if curr is not None:
+            by_currency.setdefault(curr, []).append(l)
+    for curr, ls in by_currency.items():
+        for i, a in enumerate(ls):
+            eids_a = set(country_eids[a])
+            for b in ls[i + 1:]:
+                if find(a) == find(b):
+                    continue
+                shared = eids_a.intersection(country_eids[b])
+                if len(shared) >= price_min_shared and all(prices.get((eid, a)) == prices.get((eid, b)) for eid in shared):
+                    parent[find(b)] = find(a)
+
+    groups = {}
+    for l in parent:
+        groups.setdefault(find(l), []).append(l)
+    return sorted(sorted(g) for g in groups.values() if len(g) > 1)
+
+
 def add_eshop_prices(currency):
     # certificate available
     if not os.path.isfile('ctr-common-1.crt') or not os.path.isfile('ctr-common-1.key'):
         return
-    
-    print('Adding eshop prices: ...', end = '\r')
 
     # get exchange rates
     rates = {}
-    url = 'http://www.floatrates.com/daily/{curr}.json'.format(curr=currency.lower())
-    with requests.get(url) as r:
-        tbl = r.json()
+    url = urlbase_rates.format(curr=currency.lower())
+    with requests.session() as s:
+        data = fetch(s, url)
+        t_start = time.perf_counter()
+        tbl = json.loads(data)
+        record_parse('floatrates', t_start)
         for e in tbl:
             rates[e.strip().upper()] = float(tbl[e]['rate'])
     rates[currency.upper()] = float(1.00)
-    
-    # get eshop prices
-    with requests.session() as s:
-        s.verify = False
-        s.cert=('ctr-common-1.crt', 'ctr-common-1.key')
 
-        count_all = len(merged_eshop_elements)
-        count_ok = 0
-        for cn in merged_eshop_elements:
-            eid = cn.find('title').get('id')
-            er = cn.find('eshop_regions')
-            p_best = 999999999.0
-            p_region = 'none'
-            for l in langs:
-                if er.find(l).text != 'true':
-                    continue
-                url = urlbase_price.format(eshop_id=eid, lang=l)
-                with s.get(url) as r:
-                    pdata = r.json()
-                    if not 'prices' in pdata or len(pdata['prices']) == 0:
-                        continue
-                    pd = pdata['prices'][0]
-                    if not 'sales_status' in pd or pd['sales_status'] != 'onsale':
-                        continue
-                    if not 'regular_price' in pd:
-                        continue
-                    price = None
-                    if 'discount_price' in pd:
-                        price = pd['discount_price']
-                    else:
-                        price = pd['regular_price']
-                    curr = price['currency']
-                    if not curr in rates:
-                        continue
-                    p_best_this = float(price['raw_value']) / rates[curr]
-                    if p_best_this < p_best:
-                        p_best = p_best_this
-                        p_region = l
-            # add eshop_prices
-            sel = ElementTree.SubElement(cn, 'eshop_best_price')
-            cur = ElementTree.SubElement(sel, 'p_best')
-            cur.text = str(round(p_best, 2))
-            cur = ElementTree.SubElement(sel, 'p_region')
-            cur.text = str(p_region)
-            
-            if p_region != 'none':
-                count_ok += 1
-            print('Adding eshop prices: ' + str(count_ok) + ' / ' + str(count_all) + ' entries', end = '\r')
-            
-        print('Adding eshop prices: ' + str(count_ok) + ' / ' + str(count_all) + ' entries', end = '\n')
+    # collect eshop ids per country, titles with prices from the last run are left out
+    country_eids = {l: [] for l in langs}
+    reused = {}
+    for et in merged_eshop_titles:
+        e = enriched_reused.get(et.eshop_id)
+        if e is not None and e['currency'] == currency.upper():
+            reused[et.eshop_id] = e
+            continue
+        for l in region_list(et.regions):
+            country_eids[l].append(et.eshop_id)
+
+    # get eshop prices, one country per price class
+    classes = load_price_classes()
+    queries, sources, checks = plan_eshop_prices(country_eids, classes)
+    prices = {}
+    with eshop_session(cert=True) as s, ThreadPoolExecutor(max_workers=fetch_threads) as ex:
+        count_req = query_eshop_prices(s, ex, queries, prices)
+
+        # class members that no longer agree are queried for all their titles, as are titles
+        # that would be taken from them
+        failed = set(l for eid, l, l0 in checks if prices.get((eid, l)) != prices.get((eid, l0)))
+        if failed:
+            queries = {}
+            for (eid, l), l0 in list(sources.items()):
+                if l in failed or l0 in failed:
+                    queries.setdefault(l, []).append(eid)
+                    del sources[(eid, l)]
+            count_req += query_eshop_prices(s, ex, queries, prices)
+
+    # fan out prices to the rest of each class
+    for (eid, l), l0 in sources.items():
+        if (eid, l0) in prices:
+            prices[(eid, l)] = prices[(eid, l0)]
+
+    # countries with all titles queried this run are compared to learn new classes
+    fanned = set(l for eid, l in sources)
+    known = [l for l in langs if country_eids[l] and not l in fanned]
+    classes = learn_price_classes(classes, country_eids, prices, known, failed)
+    with open(dumpdest + '/price-classes.json', 'w') as f:
+        json.dump(classes, f)
+    show_status('Adding eshop prices: ' + str(count_req) + ' requests, ' + str(sum(len(cl) for cl in classes)) + ' countries in ' + str(len(classes)) + ' price classes')
+
+    count_all = len(merged_eshop_titles)
+    count_ok = 0
+    progress = Progress('Adding eshop prices', count_all, note='{} with prices')
+    for i, et in enumerate(merged_eshop_titles):
+        if et.eshop_id in reused:
+            p_best, p_region = reused[et.eshop_id]['p_best'], reused[et.eshop_id]['p_region']
+        else:
+            p_best, p_region = best_eshop_price(et.eshop_id, et.regions, prices, rates)
+
+        # add eshop_prices
+        et.p_best = p_best
+        et.p_region = p_region
+        
+        if p_region != 'none':
+            count_ok += 1
+        progress.update(i + 1, count_ok)
+
+    progress.done('Adding eshop prices: ' + str(count_ok) + ' / ' + str(count_all) + ' entries')
 
 
 def merge_eshop_content(cn, pc, l):
     dup = False
     tt = cn.find('title')
 
-    for cn0 in merged_eshop_elements:
-        tt0 = cn0.find('title')
-        pc0 = tt0.find('product_code').text
-
-        if pc == pc0:
-            # duplicate found, merge data
-            dup = True
-
-            sel = cn0.find('eshop_regions').find(l)
-            sel.text = 'true'
-
-            if tt.find('retail_sales').text == 'true':
-                tt0.find('retail_sales').text = 'true'
-            if tt.find('eshop_sales').text == 'true':
-                tt0.find('eshop_sales').text = 'true'
-            if tt.find('demo_available').text == 'true':
-                tt0.find('demo_available').text = 'true'
-            if tt.find('aoc_available').text == 'true':
-                tt0.find('aoc_available').text = 'true'
-
-            rd = tt.find('release_date_on_eshop')
-            rd0 = tt0.find('release_date_on_eshop')
-            if rd is not None and rd0 is not None and rd0.text > rd.text:
-                rd0.text = rd.text
-            
-            rd = tt.find('release_date_on_retail')
-            rd0 = tt0.find('release_date_on_retail')
-            if rd is not None and rd0 is not None and rd0.text > rd.text:
-                rd0.text = rd.text
-
-            sr = tt.find('star_rating_info')
-            sr0 = tt0.find('star_rating_info')
-            if sr is not None and sr0 is not None:
-                vt = int(sr.find('votes').text) + int(sr0.find('votes').text)
-                s1 = int(sr.find('star1').text) + int(sr0.find('star1').text)
-                s2 = int(sr.find('star2').text) + int(sr0.find('star2').text)
-                s3 = int(sr.find('star3').text) + int(sr0.find('star3').text)
-                s4 = int(sr.find('star4').text) + int(sr0.find('star4').text)
-                s5 = int(sr.find('star5').text) + int(sr0.find('star5').text)
-                sc = round(((s1 * 1) + (s2 * 2) + (s3 * 3) + (s4 * 4) + (s5 * 5)) / vt, 2)
-
-                sr0.find('votes').text = str(vt)
-                sr0.find('star1').text = str(s1)
-                sr0.find('star2').text = str(s2)
-                sr0.find('star3').text = str(s3)
-                sr0.find('star4').text = str(s4)
-                sr0.find('star5').text = str(s5)
-                sr0.find('score').text = str(sc)
-
-            break
-
-    # not duplicate - copy, create eshop_region info and add element
+    # look up product code in the merged index
+    et = merged_eshop_index.get(pc)
+    if et is not None:
+        # duplicate found, merge data
+        dup = True
+
+        et.regions |= region_bit(l)
+
+        if tt.findtext('retail_sales') == 'true':
+            et.retail_sales = True
+        if tt.findtext('eshop_sales') == 'true':
+            et.eshop_sales = True
+        if tt.findtext('demo_available') == 'true':
+            et.demo_available = True
+        if tt.findtext('aoc_available') == 'true':
+            et.aoc_available = True
+
+        rd = tt.findtext('release_date_on_eshop')
+        if rd is not None and et.release_eshop is not None and et.release_eshop > rd:
+            et.release_eshop = rd
+
+        rd = tt.findtext('release_date_on_retail')
+        if rd is not None and et.release_retail is not None and et.release_retail > rd:
+            et.release_retail = rd
+
+        sr = tt.find('star_rating_info')
+        if sr is not None and et.stars is not None:
+            et.stars = [int(sr.findtext(st)) + st0 for st, st0 in zip(('votes', 'star1', 'star2', 'star3', 'star4', 'star5'), et.stars)]
+            vt, s1, s2, s3, s4, s5 = et.stars
+            et.score = str(round(((s1 * 1) + (s2 * 2) + (s3 * 3) + (s4 * 4) + (s5 * 5)) / vt, 2))
+
+    # not duplicate - create compact title with eshop_region info and add it
     if not dup:
-        cncp = copy.deepcopy(cn)
-        ttcp = cncp.find('title')
-
-        # add eshop_regions
-        sel = ElementTree.SubElement(cncp, 'eshop_regions')
-        for lng in langs:
-            cur = ElementTree.SubElement(sel, lng)
-            cur.text = 'false'
-            if lng == l:
-                cur.text = 'true'
+        et = EshopTitle(cn, pc)
+        et.regions |= region_bit(l)
 
         # add titlekey (if available)
-        sel = ElementTree.SubElement(cncp, 'dectitlekey')
-        if ttcp.find('eshop_sales').text == 'true':
-            for ttk in titlekeydb_data:
-                sr = ttk['serial']
-                if sr is None:
-                    continue
-
-                # workaround for bad product codes in titlekey db
-                sr_alt = None
-                if sr[3:6] == '-N-':
-                    sr_alt = sr[0:3] + '-P-' + sr[6:10]
-                elif sr[3:6] == '-P-':
-                    sr_alt = sr[0:3] + '-N-' + sr[6:10]
+        if et.eshop_sales and pc in titlekeydb_index:
+            et.titlekey = titlekeydb_index[pc]
 
-                if sr == pc or sr_alt == pc:
-                    sel.text = ttk['titleKey']
-                    break
+        merged_eshop_titles.append(et)
+        merged_eshop_index[pc] = et
 
-        # remove unneeded stuff
-        sel = ttcp.find('rating_info')
-        if sel is not None:
-            ttcp.remove(sel)
-        sel = ttcp.find('price_on_retail')
-        if sel is not None:
-            ttcp.remove(sel)
-        sel = ttcp.find('price_on_retail_detail')
-        if sel is not None:
-            ttcp.remove(sel)
-        sel = ttcp.find('tentative_price_on_eshop')
-        if sel is not None:
-            ttcp.remove(sel)
-        sel = ttcp.find('banner_url')
-        if sel is not None:
-            ttcp.remove(sel)
-
-        merged_eshop_elements.append(cncp)
+    if shard_totals is not None:
+        add_shard_totals(tt, pc)
 
     # true if new addition
     return not dup
 
 
+def add_shard_totals(tt, pc):
+    # earliest dates and summed stars over all regions of a shard. merged titles keep the values
+    # of their first region if it has none, so these are needed to merge shards in order.
+    t = shard_totals.get(pc)
+    if t is None:
+        t = shard_totals[pc] = [None, None, None]
+    rd = tt.findtext('release_date_on_eshop')
+    if rd is not None and (t[0] is None or t[0] > rd):
+        t[0] = rd
+    rd = tt.findtext('release_date_on_retail')
+    if rd is not None and (t[1] is None or t[1] > rd):
+        t[1] = rd
+    sr = tt.find('star_rating_info')
+    if sr is not None:
+        stars = [int(sr.findtext(st)) for st in ('votes', 'star1', 'star2', 'star3', 'star4', 'star5')]
+        t[2] = stars if t[2] is None else [st + st0 for st, st0 in zip(stars, t[2])]
+
+
+def reduce_eshop_shard(titles, totals):
+    # merge the partial catalog of a shard into the merged titles, same result as merging
+    # its regions one by one
+    for et in titles:
+        pc = et.product_code
+        et0 = merged_eshop_index.get(pc)
+        if et0 is None:
+            merged_eshop_titles.append(et)
+            merged_eshop_index[pc] = et
+            continue
+
+        et0.regions |= et.regions
+        et0.retail_sales |= et.retail_sales
+        et0.eshop_sales |= et.eshop_sales
+        et0.demo_available |= et.demo_available
+        et0.aoc_available |= et.aoc_available
+
+        rd_e, rd_r, stars = totals[pc]
+        if rd_e is not None and et0.release_eshop is not None and et0.release_eshop > rd_e:
+            et0.release_eshop = rd_e
+        if rd_r is not None and et0.release_retail is not None and et0.release_retail > rd_r:
+            et0.release_retail = rd_r
+        if stars is not None and et0.stars is not None:
+            et0.stars = [st + st0 for st, st0 in zip(stars, et0.stars)]
+            vt, s1, s2, s3, s4, s5 = et0.stars
+            et0.score = str(round(((s1 * 1) + (s2 * 2) + (s3 * 3) + (s4 * 4) + (s5 * 5)) / vt, 2))
+
+
+def index_eshop_groups():
+    # group merged titles on sale by (type, game id), in merged order
+    merged_eshop_groups.clear()
+    for et in merged_eshop_titles:
+        if not et.eshop_sales:
+            continue
+        pc = et.product_code
+        merged_eshop_groups.setdefault((pc[0:3], pc[6:9]), []).append((pc, et.titlekey))
+
+
+def get_eshop_ids(s, tids):
+    # eshop ids for a batch of title ids, keyed by title id
+    url = urlbase_eid.format(title_id='&title_id[]='.join(tids))
+    data = fetch(s, url)
+    t_start = time.perf_counter()
+    el = ElementTree.fromstring(data)
+    record_parse('id_pair', t_start)
+    tid_pairs = {}
+    tidpairs = el.find('title_id_pairs')
+    if tidpairs is None:
+        return tid_pairs
+    for tip in tidpairs:
+        tid_p = tip.find('title_id').text
+        eid = tip.find('ns_uid').text
+        if tid_p in tids and eid is not None:
+            tid_pairs.setdefault(tid_p, []).append(eid)
+    return tid_pairs
+
+
 def get_idlist_content(path):
     # certificate available
     if not os.path.isfile('ctr-common-1.crt') or not os.path.isfile('ctr-common-1.key'):
         return
         
-    # get list of eshop ids from args
-    eshop_ids = []
-    
-    with requests.session() as s:
-        s.verify = False
-        s.cert=('ctr-common-1.crt', 'ctr-common-1.key')
-        
-        count_ok = 0
-        count_tried = 0
-        with open(path, 'r') as fp:
-            for ln in fp:
-                tid = ln.strip().upper()
-                eid = None
-                if len(tid) != 16:
-                    continue
-                count_tried += 1
-                print('Collecting eshop ids: ...', end = '\r')
-                url = urlbase_eid.format(title_id=tid)
-                requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
-                with s.get(url) as r:
-                    el = ElementTree.fromstring(r.content)
-                    if el.find('title_id_pairs') is None:
-                        continue
-                    tidpairs = el.find('title_id_pairs')
-                    if tidpairs is None or len(list(tidpairs)) == 0:
-                        continue
-                    for tip in tidpairs:
-                        tid_p = tip.find('title_id').text
-                        if tid_p != tid:
-                            continue
-                        eid = tip.find('ns_uid').text
-                        if eid is not None and not eid in eshop_ids:
-                            count_ok += 1
-                            eshop_ids.append(eid)
-                            print('Collecting eshop ids: ' + tid + ' -> ' + eid, end = '\n')
-                
-    print('Collecting eshop ids: ' + str(count_ok) + ' / ' + str(count_tried) + ' found', end = '\n')
+    # get list of title ids from file
+    title_ids = []
+    count_tried = 0
+    with open(path, 'r') as fp:
+        for ln in fp:
+            tid = ln.strip().upper()
+            if len(tid) != 16:
+                continue
+            count_tried += 1
+            title_ids.append(tid)
+    title_ids = list(dict.fromkeys(title_ids))
+
+    # resolve batches of title ids to eshop ids in parallel
+    eshop_ids = {}
+    with eshop_session(cert=True) as s, ThreadPoolExecutor(max_workers=fetch_threads) as ex:
+        batches = [ex.submit(get_eshop_ids, s, title_ids[i:i + idpair_batch]) for i in range(0, len(title_ids), idpair_batch)]
+        tid_pairs = {}
+        progress = Progress('Collecting eshop ids', len(batches), 'requests')
+        for i, fb in enumerate(batches):
+            tid_pairs.update(fb.result())
+            progress.update(i + 1)
+
+    count_ok = 0
+    for tid in title_ids:
+        for eid in tid_pairs.get(tid, ()):
+            if not eid in eshop_ids:
+                count_ok += 1
+                eshop_ids[eid] = tid
+
+    progress.done('Collecting eshop ids: ' + str(count_ok) + ' / ' + str(count_tried) + ' found', len(batches))
     if len(eshop_ids) == 0:
         return
     
     # check eshops for title IDs
-    with requests.session() as s:
-        s.verify = False
+    with eshop_session() as s, ThreadPoolExecutor(max_workers=fetch_threads) as ex:
+        # the first page of a region's listing tells its length. not needed if even a single
+        # page costs more than requesting the titles
+        first_pages = {}
+        if len(eshop_ids) > listing_page_cost:
+            first_pages = {l: ex.submit(get_eshop_pages, s, l, 0, False) for l in live_langs()}
 
         for l in langs:
-            print('Checking ' + l + ' eshop content: ...', end = '\r')
+            if not region_live.get(l, True):
+                show_status('Checking ' + l + ' eshop content: not available')
+                continue
+
             count_ok = 0
             count_new = 0
-            offset = 0
-            title_elements = []
-            
-            if not is_eshop_available(l):
-                print('Checking ' + l + ' eshop content: not available', end = '\n')
-                continue
-            
-            for eid in eshop_ids:
-                url = urlbase_title.format(lang=l, eshop_id=eid)
-                requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
-                
-                # on screen output
-                print('Checking ' + l + ' eshop content: ' + str(count_ok) + ' / ' + str(offset) + ' entries (' + str(count_new) + ' new)', end = '\r')
-                offset += 1
-                
-                # one request per title
-                with s.get(url) as r:
-                    el = ElementTree.fromstring(r.content)
-                    if el.tag != 'eshop':
-                        continue
-                    el.tag = 'content'
-                    el.set('index', str(offset))
-                    tt = el.find('title')
-                    if tt is None:
-                        continue
-                    pc = tt.find('product_code').text
-                    title_elements.append(el)
+            dump = EshopDump(dumpdest + '/contents-eshop-' + l + '.xml', l)
 
-                    # merge eshope content
-                    if merge_eshop_content(el, pc, l):
-                        count_new += 1
-                    count_ok += 1
-            
-            print('Checking ' + l + ' eshop content: ' + str(count_ok) + ' / ' + str(offset) + ' entries (' + str(count_new) + ' new)', end = '\n')
+            pages = plan_idlist_listing(l, eshop_ids, first_pages.get(l))
+            if pages is None:
+                contents = get_idlist_titles(s, ex, l, eshop_ids)
+                requests_done = str(len(eshop_ids)) + ' title requests'
+            else:
+                contents, count_unlisted = get_idlist_listing(s, ex, l, eshop_ids, first_pages[l], pages)
+                requests_done = str(len(pages) + 1) + ' pages and ' + str(count_unlisted) + ' title requests'
+
+            for cn in contents:
+                pc = cn.find('title').find('product_code').text
+                dump.append(cn)
+
+                # merge eshope content
+                if merge_eshop_content(cn, pc, l):
+                    count_new += 1
+                count_ok += 1
+
+            show_status('Checking ' + l + ' eshop content: ' + str(count_ok) + ' / ' + str(len(eshop_ids)) + ' entries (' + str(count_new) + ' new), ' + requests_done)
             if count_ok > 0:
                 # save to file
-                out = dumpdest + '/contents-eshop-' + l + '.xml'
-                write_eshop_content(title_elements, out)
+                dump.close()
 
     # save merged data to file
     add_eshop_ec_info()
     out = dumpdest + '/contents-eshop-MERGED.xml'
-    write_eshop_content(merged_eshop_elements, out)
+    write_merged_content(out)
+    index_eshop_groups()
  
 
-def get_eshop_content():
-    # handle eshop content
-    with requests.session() as s:
-        s.verify = False
-
-        for l in langs:
-            print('Scraping ' + l + ' eshop content: ...', end = '\r')
+def plan_idlist_listing(l, eshop_ids, first_page):
+    # offsets of the remaining listing pages if paging the listing is cheaper than one request
+    # per title, None otherwise. the region listing only has the titles currently on sale there,
+    # the others are still requested one by one. how many of them are listed is estimated from
+    # the share of wanted titles on the first page.
+    count = len(eshop_ids)
+    if first_page is None:
+        return None
+    contents_root, contents = parse_eshop_page(first_page.result()[0])
+    if contents_root is None or contents_root.get('total') is None or int(contents_root.get('length')) <= 0:
+        show_status('Checking ' + l + ' eshop content: ' + str(count) + ' title requests, listing length unknown')
+        return None
+    total = int(contents_root.get('total'))
+    length = int(contents_root.get('length'))
+    pages = list(range(length, total, length))
+    count_first = sum(1 for cn in contents if cn.find('title') is not None and cn.find('title').get('id') in eshop_ids)
+    count_unlisted = max(count - round(count_first * total / length), 0)
+    cost = len(pages) * listing_page_cost + count_unlisted
+    reason = 'listing of ' + str(total) + ' titles in ' + str(len(pages) + 1) + ' pages and about ' + str(count_unlisted) + ' unlisted title requests (cost ' + str(cost) + ')'
+    if cost >= count:
+        show_status('Checking ' + l + ' eshop content: ' + str(count) + ' title requests, cheaper than ' + reason)
+        return None
+    show_status('Checking ' + l + ' eshop content: ' + reason + ', cheaper than ' + str(count) + ' title requests')
+    return pages
+
+
+def get_idlist_titles(s, ex, l, eshop_ids):
+    # one request per title in parallel, returns the content elements in list order
+    titles = [ex.submit(get_idlist_title, s, l, eid, i + 1) for i, eid in enumerate(eshop_ids)]
+    found = []
+    progress = Progress('Checking ' + l + ' eshop content', len(titles), 'titles')
+    for i, ft in enumerate(titles):
+        progress.update(i)
+        el = ft.result()
+        if el is not None:
+            found.append(el)
+    return found
+
+
+def get_idlist_title(s, l, eid, index):
+    # content element of a single title, None if the region does not have it
+    data = fetch(s, urlbase_title.format(lang=l, eshop_id=eid))
+    t_start = time.perf_counter()
+    el = ElementTree.fromstring(data)
+    record_parse('samurai title', t_start)
+    if el.tag != 'eshop':
+        return None
+    el.tag = 'content'
+    el.set('index', str(index))
+    if el.find('title') is None:
+        return None
+    return el
+
+
+def get_idlist_listing(s, ex, l, eshop_ids, first_page, pages):
+    # pages the region listing and keeps the wanted titles, indexed and ordered as if they
+    # were requested one by one. titles the listing does not have (hidden or delisted ones)
+    # are requested one by one after it. returns them and the number of those requests.
+    positions = {eid: i + 1 for i, eid in enumerate(eshop_ids)}
+    region_pages = [first_page] + [ex.submit(get_eshop_pages, s, l, offs, False) for offs in pages]
+    found = []
+    progress = Progress('Checking ' + l + ' eshop content', len(region_pages), 'pages')
+    for i, fp in enumerate(region_pages):
+        progress.update(i)
+        contents_root, contents = parse_eshop_page(fp.result()[0])
+        for cn in contents:
+            tt = cn.find('title')
+            # a title can show up twice when the listing shifts while paging, the first one is kept
+            if tt is not None and tt.get('id') in positions:
+                cn.set('index', str(positions.pop(tt.get('id'))))
+                found.append(cn)
+    progress.update(len(region_pages))
+    unlisted = [ex.submit(get_idlist_title, s, l, eid, index) for eid, index in positions.items()]
+    found += [cn for cn in (fu.result() for fu in unlisted) if cn is not None]
+    found.sort(key=lambda cn: int(cn.get('index')))
+    return found, len(unlisted)
+
+
+def feed_eshop_page(data):
+    # pull-parse a response in chunks, yields (event, element) pairs
+    parser = ElementTree.XMLPullParser(events=('start', 'end'))
+    for i in range(0, len(data), 65536):
+        t_start = time.perf_counter()
+        parser.feed(data[i:i + 65536])
+        events = list(parser.read_events())
+        record_parse('samurai titles', t_start)
+        yield from events
+    parser.close()
+    yield from parser.read_events()
+
+
+def parse_eshop_page(data):
+    # returns the contents element of a page of titles (None if there is none) and a
+    # generator of the content elements in it. the contents element is still empty at
+    # this point, the titles are parsed one at a time while iterating.
+    events = feed_eshop_page(data)
+    for ev, el in events:
+        if ev == 'start' and el.tag == 'contents':
+            return el, iter_eshop_page(events, el)
+    return None, iter(())
+
+
+def iter_eshop_page(events, contents_root):
+    # each content is handed out once its tail is parsed too, and is dropped from
+    # the tree afterwards
+    depth = 0
+    pending = None
+    for ev, el in events:
+        if depth == 0 and pending is not None:
+            yield pending
+            contents_root.remove(pending)
+            pending = None
+        if ev == 'start':
+            depth += 1
+        elif depth == 0:
+            # end of contents
+            break
+        else:
+            depth -= 1
+            if depth == 0:
+                pending = el
+    if pending is not None:
+        yield pending
+
+
+class EshopDump:
+    # writes a region dump one title at a time, same output as write_eshop_content
+
+    def __init__(self, out, region):
+        self.out = out
+        self.region = region
+        self.part = None
+        self.count = 0
+        self.index = 0
+        self.in_order = True
+        if catalog is not None:
+            catalog.execute('delete from listings where region = ?', (region,))
+
+    def append(self, cn):
+        if self.part is None:
+            self.part = open(self.out + '.part', 'w+b')
+        index = int(cn.get('index'))
+        if index < self.index:
+            self.in_order = False
+        self.index = index
+        data = ElementTree.tostring(cn)
+        self.part.write(data)
+        self.count += 1
+        if catalog is not None:
+            tt = cn.find('title')
+            catalog.execute('insert or replace into listings values (?, ?, ?, ?, ?)', (self.region, index, tt.findtext('product_code'), tt.get('id'), data))
+
+    def close(self):
+        if self.part is None:
+            write_eshop_content([], self.out)
+            return
+        self.part.seek(0)
+        if self.in_order:
+            with open(self.out, 'wb') as f:
+                f.write(b'<contents contents="' + str(self.count).encode('ascii') + b'">')
+                shutil.copyfileobj(self.part, f)
+                f.write(b'</contents>')
+        else:
+            # titles did not arrive sorted by index, let write_eshop_content sort them
+            el = list(ElementTree.fromstring(b'<contents>' + self.part.read() + b'</contents>'))
+            write_eshop_content(el, self.out)
+        self.part.close()
+        os.remove(self.out + '.part')
+
+
+def get_eshop_pages(s, l, offset, follow):
+    # fetch one page of titles, or keep paging until the end if follow is set. incremental runs
+    # revalidate every page with the server, unchanged pages come back as 304 from the cache.
+    pages = []
+    while True:
+        url = urlbase_eshop.format(lang=l, offs=offset)
+        data = fetch(s, url, revalidate=incremental)
+        pages.append(data)
+        if not follow:
+            break
+        # the only element inside an eshop element should be a contents one.
+        contents_root = parse_eshop_page(data)[0]
+        if contents_root is None or int(contents_root.get('length')) <= 0:
+            break
+        offset += int(contents_root.get('length'))
+    return pages
+
+
+def eshop_page_jobs(s, ex):
+    # page requests in merge order as (region, future), submitted as they are taken. first pages
+    # are requested fetch_threads regions ahead, they tell how many pages the region has.
+    regions = live_langs()
+    first_pages = {}
+    for i, l in enumerate(regions):
+        for l1 in regions[i:i + fetch_threads]:
+            if not l1 in first_pages:
+                first_pages[l1] = ex.submit(get_eshop_pages, s, l1, 0, False)
+        fp = first_pages.pop(l)
+        yield l, fp
+
+        contents_root = parse_eshop_page(fp.result()[0])[0]
+        if contents_root is None:
+            continue
+        length = int(contents_root.get('length'))
+        if length <= 0:
+            continue
+        total = contents_root.get('total')
+        if total is None:
+            # without a total, the rest of the region is paged through in one job
+            yield l, ex.submit(get_eshop_pages, s, l, length, True)
+            continue
+        for offs in range(length, int(total), length):
+            yield l, ex.submit(get_eshop_pages, s, l, offs, False)
+
+
+def read_ahead(jobs, count):
+    # keeps count jobs submitted ahead of the one being consumed
+    window = deque()
+    for job in jobs:
+        window.append(job)
+        if len(window) > count:
+            yield window.popleft()
+    yield from window
+
+
+def scrape_eshop_regions():
+    # scrape and merge all live regions
+    with eshop_session() as s, ThreadPoolExecutor(max_workers=fetch_threads) as ex:
+        # merge in region and page order, same as a serial run
+        jobs = read_ahead(eshop_page_jobs(s, ex), scrape_ahead * fetch_threads)
+        for l, region_jobs in groupby(jobs, key=lambda job: job[0]):
+            progress = Progress('Scraping ' + l + ' eshop content', note='{} new')
             count_ok = 0
             count_new = 0
             offset = 0
-            title_elements = []
-            while True:
-                url = urlbase_eshop.format(lang=l, offs=offset)
-                requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
-                with s.get(url) as r:
-                # with s.get(url, verify='nintendo-ca-g3.pem') as r:
-                    el = ElementTree.fromstring(r.content)
-                    # check this eshop
-                    if el.find('contents') is None:
-                        break
-                    # the only element inside an eshop element should be a contents one.
-                    contents_root = list(el)[0]
-
-                    # check length
-                    length = int(contents_root.get('length'))
-                    if length <= 0:
-                        break
-                    offset += length
+            dump = EshopDump(dumpdest + '/contents-eshop-' + l + '.xml', l)
+            for data in (pg for _, fp in region_jobs for pg in fp.result()):
+                # check this eshop
+                contents_root, contents = parse_eshop_page(data)
+                if contents_root is None:
+                    break
 
-                    # on screen output
-                    print('Scraping ' + l + ' eshop content: ' + str(count_ok) + ' / ' + str(offset) + ' entries (' + str(count_new) + ' new)', end = '\r')
+                # check length
+                length = int(contents_root.get('length'))
+                if length <= 0:
+                    break
+                offset += length
+                if contents_root.get('total') is not None:
+                    progress.total = int(contents_root.get('total'))
 
-                    # clean up and add elements from the contents root to the title_elements lists
-                    for cn in contents_root:
-                        tt = cn.find('title')
-                        if tt is None:
-                            continue
-                        pc = tt.find('product_code').text
-                        title_elements.append(cn)
+                # merge titles and append them to the region dump while parsing
+                for cn in contents:
+                    tt = cn.find('title')
+                    if tt is None:
+                        continue
+                    pc = tt.find('product_code').text
+                    dump.append(cn)
+
+                    # merge eshope content
+                    if merge_eshop_content(cn, pc, l):
+                        count_new += 1
+                    count_ok += 1
 
-                        # merge eshope content
-                        if merge_eshop_content(cn, pc, l):
-                            count_new += 1
-                        count_ok += 1
+                    # on screen output
+                    progress.update(count_ok, count_new)
 
             if offset > 0:
-                print('Scraping ' + l + ' eshop content: ' + str(count_ok) + ' / ' + str(offset) + ' entries (' + str(count_new) + ' new)', end = '\n')
+                progress.done('Scraping ' + l + ' eshop content: ' + str(count_ok) + ' / ' + str(offset) + ' entries (' + str(count_new) + ' new)')
                 # save to file
-                out = dumpdest + '/contents-eshop-' + l + '.xml'
-                write_eshop_content(title_elements, out)
+                dump.close()
+
+
+def scrape_eshop_shard(settings, shard):
+    # runs in a worker process, scrapes the regions of a shard into a partial merged catalog
+    global catalog, shard_totals
+    globals().update(settings)
+    sys.stdout = open(os.devnull, 'w')
+    catalog = None
+    shard_totals = {}
+    merged_eshop_titles.clear()
+    merged_eshop_index.clear()
+    metrics_endpoints.clear()
+    host_limiters.clear()
+    for l in langs:
+        if not l in shard:
+            region_live[l] = False
+    scrape_eshop_regions()
+    return merged_eshop_titles, shard_totals, metrics_endpoints
+
+
+def add_shard_metrics(metrics):
+    for name, m in metrics.items():
+        m0 = endpoint_metrics(name)
+        for key, value in m.items():
+            if key == 'max_ms':
+                m0[key] = max(m0[key], value)
+            elif key == 'latency_ms':
+                for bucket, n in value.items():
+                    m0[key][bucket] += n
+            else:
+                m0[key] += value
+
+
+def scrape_eshop_shards():
+    # contiguous shards of regions, a few per process to even out their sizes
+    regions = live_langs()
+    count = min(len(regions), scrape_processes * 4)
+    shards = [regions[i * len(regions) // count:(i + 1) * len(regions) // count] for i in range(count)]
+    settings = {name: globals()[name] for name in shard_globals}
+    settings['fetch_threads'] = max(1, fetch_threads // scrape_processes)
+
+    progress = Progress('Scraping eshop content', len(regions), 'regions', '{} titles')
+    count_done = 0
+    with ProcessPoolExecutor(max_workers=scrape_processes) as ex:
+        parts = [ex.submit(scrape_eshop_shard, settings, shard) for shard in shards]
+        for shard, fp in zip(shards, parts):
+            titles, totals, metrics = fp.result()
+            reduce_eshop_shard(titles, totals)
+            with metrics_lock:
+                add_shard_metrics(metrics)
+            count_done += len(shard)
+            progress.update(count_done, len(merged_eshop_titles))
+    progress.done('Scraping eshop content: ' + str(count_done) + ' / ' + str(len(regions)) + ' regions (' + str(len(merged_eshop_titles)) + ' titles)')
+
+    # region listings of the catalog are taken from the dumps
+    if catalog is not None:
+        for l in regions:
+            path = dumpdest + '/contents-eshop-' + l + '.xml'
+            if os.path.isfile(path):
+                catalog.execute('delete from listings where region = ?', (l,))
+                catalog.executemany('insert or replace into listings values (?, ?, ?, ?, ?)', ((l, int(cn.get('index')), cn.find('title').findtext('product_code'), cn.find('title').get('id'), ElementTree.tostring(cn)) for cn in ElementTree.parse(path).getroot()))
+
+
+def get_eshop_content():
+    # handle eshop content
+    with metrics_lock:
+        m = dict(endpoint_metrics('samurai titles'))
+    if scrape_processes > 1 and len(live_langs()) > 1:
+        scrape_eshop_shards()
+    else:
+        scrape_eshop_regions()
+    if incremental:
+        with metrics_lock:
+            m1 = endpoint_metrics('samurai titles')
+            show_status('Revalidating eshop pages: ' + str(m1['not_modified'] - m['not_modified']) + ' / ' + str(m1['requests'] - m['requests']) + ' unchanged')
 
     # save merged data to file
     add_eshop_ec_info()
     out = dumpdest + '/contents-eshop-MERGED.xml'
-    write_eshop_content(merged_eshop_elements, out)
+    write_merged_content(out)
+    index_eshop_groups()
 
 
 def get_3dsdb_content():
-    print('Loading 3DSDB cart data: ...', end = '\r')
-
-    url = 'http://3dsdb.com/xml.php'
-    with requests.get(url) as r:
-        out = dumpdest + '/3dsdb.xml'
-        with open(out, 'wb') as f:
-            f.write(r.content)
-
-        el = ElementTree.fromstring(r.content)
+    progress = Progress('Loading 3DSDB cart data', note='{} kept')
 
-        # count and get rid of crap (eshop, demo, update, movie, selfmade) entries
-        count_all = 0
-        count_ok = 0
-        for rl in el:
-            print('Loading 3DSDB cart data: ' + str(count_ok) + ' / ' + str(count_all) + ' entries', end = '\r')
-
-            count_all += 1
-            type = rl.find('type').text
-            serial = rl.find('serial').text
-            code = serial[4:8]
-            if not serial.startswith(('CTR-', 'KTR-')):
-                continue
-            if not code.startswith(('A', 'B', 'C', 'E')):
-                continue
-            if type != '1':
-                continue
-
-            dup = False
-            for rl0 in el:
-                if rl is rl0:
-                    break
-                elif serial == rl0.find('serial').text:
-                    dup = True
-                    break
-            if dup:
-                continue
-
-            db_release_elements.append(rl)
-            count_ok += 1
-
-        print('Loading 3DSDB cart data: ' + str(count_ok) + ' / ' + str(count_all) + ' entries', end = '\n')
+    # stream the dump to disk instead of holding it in memory
+    out = dumpdest + '/3dsdb.xml'
+    with requests.session() as s:
+        fetch(s, url_3dsdb, out=out)
+
+    # count and get rid of crap (eshop, demo, update, movie, selfmade) entries
+    count_all = 0
+    count_ok = 0
+    serials_seen = set()
+    t_start = time.perf_counter()
+    it = ElementTree.iterparse(out, events=('start', 'end'))
+    _, root = next(it)
+    for ev, rl in it:
+        if ev != 'end' or rl.tag != 'release':
+            continue
+        progress.update(count_all, count_ok)
+
+        count_all += 1
+        type = rl.find('type').text
+        serial = rl.find('serial').text
+        code = serial[4:8]
+        rec = DbRelease(rl.find('id').text, serial, rl.find('titleid').text, rl.find('name').text, rl.find('publisher').text, rl.find('region').text, rl.find('languages').text, rl.find('trimmedsize').text)
+        root.clear()
+
+        # duplicates are checked against all earlier releases, not just the kept ones
+        dup = serial in serials_seen
+        serials_seen.add(serial)
+
+        if not serial.startswith(('CTR-', 'KTR-')):
+            continue
+        if not code.startswith(('A', 'B', 'C', 'E')):
+            continue
+        if type != '1':
+            continue
+        if dup:
+            continue
+
+        db_release_elements.append(rec)
+        db_release_index[serial] = rec.id
+        count_ok += 1
+    record_parse('3dsdb', t_start)
+
+    progress.done('Loading 3DSDB cart data: ' + str(count_ok) + ' / ' + str(count_all) + ' entries', count_all)
 
 
 def get_titlekeydb_data():
     global titlekeydb_data
-    print('Loading titlekeydb data: ...', end = '\r')
+    progress = Progress('Loading titlekeydb data')
 
     url = titlekeyurl + '/json'
-    with requests.get(url) as r:
+    with requests.session() as s:
+        content = fetch(s, url)
         out = dumpdest + '/titlekeydb.json'
         with open(out, 'wb') as f:
-            f.write(r.content)
-        titlekeydb_data = r.json()
-
-        print('Loading titlekeydb data: ' + str(len(titlekeydb_data)) + ' entries', end = '\n')
+            f.write(content)
+        t_start = time.perf_counter()
+        titlekeydb_data = json.loads(content)
+        record_parse('titlekey', t_start)
+        index_titlekeydb()
+
+        progress.done('Loading titlekeydb data: ' + str(len(titlekeydb_data)) + ' entries', len(titlekeydb_data))
+
+
+def index_titlekeydb():
+    # map serials (and their N/P alternates) to titlekeys, first entry wins
+    titlekeydb_index.clear()
+    for ttk in titlekeydb_data:
+        sr = ttk['serial']
+        if sr is None:
+            continue
+        titlekeydb_index.setdefault(sr, ttk['titleKey'])
+
+        # workaround for bad product codes in titlekey db
+        if sr[3:6] == '-N-':
+            titlekeydb_index.setdefault(sr[0:3] + '-P-' + sr[6:10], ttk['titleKey'])
+        elif sr[3:6] == '-P-':
+            titlekeydb_index.setdefault(sr[0:3] + '-N-' + sr[6:10], ttk['titleKey'])
+
+
+def open_catalog(path):
+    global catalog
+    catalog = sqlite3.connect(path)
+    catalog.executescript(catalog_schema)
+
+
+def store_catalog(currency):
+    # replace merged titles, releases, titlekeys and prices with the data of this run
+    progress = Progress('Storing catalog')
+    catalog.execute('delete from titles')
+    catalog.executemany('insert into titles values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', ((et.product_code, et.product_code[0:3], et.product_code[6:9], et.product_code[0:3] + '-' + et.product_code[6:10], et.eshop_id, et.ec_title_id or None, et.name, et.publisher, et.publisher_id, et.platform_id, et.genre, et.ec_size, et.release_eshop, et.release_retail, et.eshop_sales, '/'.join(region_list(et.regions)), et.score, et.stars[0] if et.score is not None else None, et.titlekey) for et in merged_eshop_titles))
+    if db_release_elements:
+        catalog.execute('delete from releases')
+        catalog.executemany('insert into releases values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', ((rl.id, rl.serial, rl.serial[0:3], rl.serial[4:7], rl.titleid, rl.name, rl.publisher, rl.region, rl.languages, rl.trimmedsize) for rl in db_release_elements))
+    if titlekeydb_data:
+        catalog.execute('delete from titlekeys')
+        catalog.executemany('insert into titlekeys values (?, ?, ?, ?, ?, ?, ?)', ((ttk['titleID'], ttk['serial'], ttk['titleKey'], ttk['encTitleKey'], ttk['password'], ttk['name'], ttk['size']) for ttk in titlekeydb_data))
+    if currency:
+        catalog.execute('delete from prices where currency = ?', (currency,))
+        catalog.executemany('insert into prices values (?, ?, ?, ?, ?)', ((currency, et.eshop_id, et.product_code, et.p_best, et.p_region) for et in merged_eshop_titles if et.p_best is not None))
+    catalog.commit()
+    progress.done('Storing catalog: ' + str(len(merged_eshop_titles)) + ' titles', len(merged_eshop_titles))
 
 
 def analyse_3dsdb(english_only):
@@ -520,10 +1835,11 @@ def analyse_3dsdb(english_only):
         dbw.writeheader()
         count_all = len(db_release_elements)
         count_missing = 0
+        progress = Progress('Adding missing entries from 3dsdb.com', count_all, note='{} missing')
 
-        for rl in db_release_elements:
-            print('Adding missing entries from 3dsdb.com: ' + str(count_missing) + ' / ' + str(count_all) + ' entries', end = '\r')
-            serial = rl.find('serial').text
+        for i, rl in enumerate(db_release_elements):
+            progress.update(i, count_missing)
+            serial = rl.serial
             type = serial[0:3]
             code = serial[4:8]
             gid = serial[4:7]
@@ -536,17 +1852,13 @@ def analyse_3dsdb(english_only):
             if english_only and not rid in ('A', 'E', 'P'):
                 continue
 
-            found = False
-            for cn in merged_eshop_elements:
-                pc = cn.find('title').find('product_code').text
-                es = cn.find('title').find('eshop_sales').text
-                ttk = cn.find('dectitlekey').text
+            found = pc_n in merged_eshop_index or pc_p in merged_eshop_index
+            for pc, ttk in merged_eshop_groups.get((type, gid), ()):
                 if pc == pc_n or pc == pc_p:
-                    found = True
-                elif pc[0:3] == type and pc[6:9] == gid and es == 'true':
-                    eshop_alt.append(pc)
-                    if ttk is not None:
-                        eshop_alt_ttk.append(pc)
+                    continue
+                eshop_alt.append(pc)
+                if ttk is not None:
+                    eshop_alt_ttk.append(pc)
 
             best_alt = ''
             if rid in region_id_pref:
@@ -558,20 +1870,22 @@ def analyse_3dsdb(english_only):
                             ba_pref = ba_pref0
                             best_alt = a
 
-            title_id = rl.find('titleid').text
-            region = rl.find('region').text
-            lang = rl.find('languages').text
-            name = rl.find('name').text
-            pub = rl.find('publisher').text
-            dbid = rl.find('id').text
-            size = rl.find('trimmedsize').text
+            title_id = rl.titleid
+            region = rl.region
+            lang = rl.languages
+            name = rl.name
+            pub = rl.publisher
+            dbid = rl.id
+            size = rl.trimmedsize
 
+            row = {'title_id': title_id, 'product_code': pc_p, 'region_id': rid, 'name': name, 'publisher': pub, 'region': region, 'languages': lang, 'size': size, '3dsdb_id': dbid, 'alternative_download': ' / '.join(eshop_alt), 'alternative_with_titlekey': ' / '.join(eshop_alt_ttk), 'best_alternative': best_alt}
             if not found:
-                mdw.writerow({'title_id': title_id, 'product_code': pc_p, 'region_id': rid, 'name': name, 'publisher': pub, 'region': region, 'languages': lang, 'size': size, '3dsdb_id': dbid, 'alternative_download': ' / '.join(eshop_alt), 'alternative_with_titlekey': ' / '.join(eshop_alt_ttk), 'best_alternative': best_alt})
+                mdw.writerow(row)
+                missing_3dsdb_rows.append(row)
                 count_missing += 1
-            dbw.writerow({'title_id': title_id, 'product_code': pc_p, 'region_id': rid, 'name': name, 'publisher': pub, 'region': region, 'languages': lang, 'size': size, '3dsdb_id': dbid, 'alternative_download': ' / '.join(eshop_alt), 'alternative_with_titlekey': ' / '.join(eshop_alt_ttk), 'best_alternative': best_alt})
+            dbw.writerow(row)
 
-        print('Adding missing entries from 3dsdb.com: ' + str(count_missing) + ' / ' + str(count_all) + ' entries', end = '\n')
+        progress.done('Adding missing entries from 3dsdb.com: ' + str(count_missing) + ' / ' + str(count_all) + ' entries', count_all)
 
 
 def dump_titlekeydb():
@@ -580,141 +1894,109 @@ def dump_titlekeydb():
         ttkw.writeheader()
 
         count_ok = 0
+        progress = Progress('Dumping titlekeydb data', len(titlekeydb_data))
         for ttk in titlekeydb_data:
-            print('Dumping titlekeydb data: ' + str(count_ok) + ' entries', end = '\r')
+            progress.update(count_ok)
             ttkw.writerow({'title_id': ttk['titleID'], 'product_code': ttk['serial'], 'titlekey_dec': ttk['titleKey'], 'titlekey_enc': ttk['encTitleKey'], 'password': ttk['password'], 'name': ttk['name'], 'size': ttk['size']})
             count_ok += 1
-        print('Dumping titlekeydb data: ' + str(count_ok) + ' entries', end = '\n')
+        progress.done('Dumping titlekeydb data: ' + str(count_ok) + ' entries', count_ok)
+
+
+def load_missing_3dsdb():
+    # 3dsdb was not checked in this run, use the missing entries from an earlier one
+    try:
+        with open(csv_missing_3dsdb_from_eshop, encoding='utf-8') as md_csv:
+            missing_3dsdb_rows.extend(csv.DictReader(md_csv))
+    except FileNotFoundError:
+        pass
+
+
+def eshop_analysis_rows():
+    # process merged eshop titles
+    for et in merged_eshop_titles:
+        pc = et.product_code
+        rid = pc[9:10]
+        pid = et.platform_id
+        name = et.name
+        genre = et.genre
+        pub_name = et.publisher
+        pub_id = et.publisher_id
+        p_best = '-'
+        p_reg = '-'
+        if et.p_best is not None:
+            p_best = et.p_best
+            p_reg = et.p_region
+
+        rel_e = ''
+        if et.release_eshop is not None:
+            rel_e = et.release_eshop
+
+        rel_r = ''
+        if et.release_retail is not None:
+            rel_r = et.release_retail
+
+        eshop_regs = list(region_list(et.regions))
+
+        score = ''
+        votes = ''
+        if et.score is not None:
+            score = et.score
+            votes = str(et.stars[0])
+
+        titlekey = et.titlekey
+        titlekey_known = 'false'
+        if titlekey is not None and titlekey != '':
+            titlekey_known = 'true'
+
+        serial = pc[0:3] + '-' + pc[6:10]
+        dbid = db_release_index.get(serial, '')
+
+        code = pc[6:10]
+        gid = pc[6:9]
+        type = pc[0:3]
+        eshop_alt = []
+        eshop_alt_ttk = []
+        for pc0, ttk0 in merged_eshop_groups.get((type, gid), ()):
+            if pc0[6:10] != code:
+                eshop_alt.append(pc0)
+                if ttk0 is not None:
+                    eshop_alt_ttk.append(pc0)
+
+        best_alt = ''
+        if rid in region_id_pref:
+            ba_pref = region_id_pref[rid]
+            for a in eshop_alt:
+                if a[9:10] in region_id_pref:
+                    ba_pref0 = region_id_pref[a[9:10]]
+                    if ba_pref0 < ba_pref:
+                        ba_pref = ba_pref0
+                        best_alt = a
+
+        platform = platform_dict[pid]
+        if platform is None:
+            platform = ''
+
+        title_id = et.ec_title_id
+        size = et.ec_size
+
+        yield {'title_id': title_id, 'product_code': pc, 'region_id': rid, 'name': name, 'publisher': pub_name, 'publisher_id': pub_id, 'platform': platform, 'platform_id' : pid, 'genre': genre, 'size': size, 'release_eshop': rel_e, 'release_retail': rel_r, 'eshop_regions': '/'.join(eshop_regs), 'score': score, 'votes': votes, 'best_price' : p_best, 'best_price_region' : p_reg, 'titlekey_known': titlekey_known, '3dsdb_id': dbid, 'alternative_download': ' / '.join(eshop_alt), 'alternative_with_titlekey': ' / '.join(eshop_alt_ttk), 'best_alternative': best_alt}
+
+    # append data from 3DSDB
+    for r in missing_3dsdb_rows:
+        yield {'title_id': r['title_id'], 'product_code': r['product_code'], 'region_id': r['region_id'], 'name': r['name'], 'publisher': r['publisher'], 'platform': platform_dict['18'], 'platform_id': '18', 'size': r['size'], 'release_retail': '3DSDB', '3dsdb_id': r['3dsdb_id'], 'alternative_download': r['alternative_download'], 'alternative_with_titlekey': r['alternative_with_titlekey'], 'best_alternative': r['best_alternative']}
 
 
 def build_eshop_analysis():
-    with open(csv_eshop_analysis, 'w', encoding='utf-8') as ea_csv:
+    # all result files are written in a single pass over the merged titles
+    with open(csv_eshop_analysis, 'w', encoding='utf-8') as ea_csv, open(csv_missing_retail_dumps_no_download, 'w', encoding='utf-8') as mrd_csv, open(csv_missing_downloads_only_retail, 'w', encoding='utf-8') as mdr_csv, open(csv_missing_titlekeys, 'w', encoding='utf-8') as mtk_csv, open(csv_missing_archive_eshop, 'w', encoding='utf-8') as mfe_csv, open(csv_missing_archive_all, 'w', encoding='utf-8') as mfa_csv, open(csv_unique_downloads, 'w', encoding='utf-8') as ud_csv:
         eaw = csv.DictWriter(ea_csv, fieldnames = csv_fieldnames_eshop, lineterminator='\n')
-        eaw.writeheader()
-        count_all = len(merged_eshop_elements)
-        count_ok = 0
-
-        # process merged eshop elements
-        for cn in merged_eshop_elements:
-            print('Merging all entries: ' + str(count_ok) + ' / ' + str(count_all) + ' entries', end = '\r')
-
-            tt = cn.find('title')
-            pl = tt.find('platform')
-            pub = tt.find('publisher')
-            sr = tt.find('star_rating_info')
-            es = cn.find('eshop_regions')
-            ec = cn.find('title_ec_info')
-            ep = cn.find('eshop_best_price')
-
-            pc = tt.find('product_code').text
-            rid = pc[9:10]
-            pid = pl.get('id')
-            name = tt.find('name').text
-            genre = tt.find('display_genre').text
-            pub_name = pub.find('name').text
-            pub_id = pub.get('id')
-            p_best = '-'
-            p_reg = '-'
-            if ep is not None:
-                p_best = ep.find('p_best').text
-                p_reg = ep.find('p_region').text
-
-            rel_e = ''
-            if tt.find('release_date_on_eshop') is not None:
-                rel_e = tt.find('release_date_on_eshop').text
-
-            rel_r = ''
-            if tt.find('release_date_on_retail') is not None:
-                rel_r = tt.find('release_date_on_retail').text
-
-            eshop_regs = []
-            for l in langs:
-                if es.find(l).text == 'true':
-                    eshop_regs.append(l)
-
-            score = ''
-            votes = ''
-            if sr is not None and sr.find('score') is not None:
-                score = sr.find('score').text
-                votes = sr.find('votes').text
-
-            titlekey = cn.find('dectitlekey').text
-            titlekey_known = 'false'
-            if titlekey is not None and titlekey != '':
-                titlekey_known = 'true'
-
-            dbid = ''
-            serial = pc[0:3] + '-' + pc[6:10]
-            for rl in db_release_elements:
-                if rl.find('serial').text == serial:
-                    dbid = rl.find('id').text
-                    break
-
-            code = pc[6:10]
-            gid = pc[6:9]
-            type = pc[0:3]
-            eshop_alt = []
-            eshop_alt_ttk = []
-            for cn0 in merged_eshop_elements:
-                ttk0 = cn0.find('dectitlekey').text
-                es0 = cn0.find('title').find('eshop_sales').text
-                pc0 = cn0.find('title').find('product_code').text
-                code0 = pc0[6:10]
-                gid0 = pc0[6:9]
-                type0 = pc0[0:3]
-                if code0 != code and type0 == type and gid0 == gid and es0 == 'true':
-                    eshop_alt.append(pc0)
-                    if ttk0 is not None:
-                        eshop_alt_ttk.append(pc0)
-
-            best_alt = ''
-            if rid in region_id_pref:
-                ba_pref = region_id_pref[rid]
-                for a in eshop_alt:
-                    if a[9:10] in region_id_pref:
-                        ba_pref0 = region_id_pref[a[9:10]]
-                        if ba_pref0 < ba_pref:
-                            ba_pref = ba_pref0
-                            best_alt = a
-
-            platform = platform_dict[pid]
-            if platform is None:
-                platform = ''
-
-            title_id = ''
-            size = '0'
-            if ec is not None:
-                title_id = ec.find('title_id').text
-                if ec.find('content_size') is not None:
-                    size = ec.find('content_size').text
-
-            eaw.writerow({'title_id': title_id, 'product_code': pc, 'region_id': rid, 'name': name, 'publisher': pub_name, 'publisher_id': pub_id, 'platform': platform, 'platform_id' : pid, 'genre': genre, 'size': size, 'release_eshop': rel_e, 'release_retail': rel_r, 'eshop_regions': '/'.join(eshop_regs), 'score': score, 'votes': votes, 'best_price' : p_best, 'best_price_region' : p_reg, 'titlekey_known': titlekey_known, '3dsdb_id': dbid, 'alternative_download': ' / '.join(eshop_alt), 'alternative_with_titlekey': ' / '.join(eshop_alt_ttk), 'best_alternative': best_alt})
-            count_ok += 1
-
-        # try append data from 3DSDB
-        try:
-            with open(csv_missing_3dsdb_from_eshop, encoding='utf-8') as md_csv:
-                mdr = csv.DictReader(md_csv)
-                for r in mdr:
-                    print('Merging all entries: ' + str(count_ok) + ' / ' + str(count_all) + ' entries', end = '\r')
-                    eaw.writerow({'title_id': r['title_id'], 'product_code': r['product_code'], 'region_id': r['region_id'], 'name': r['name'], 'publisher': r['publisher'], 'platform': platform_dict['18'], 'platform_id': '18', 'size': r['size'], 'release_retail': '3DSDB', '3dsdb_id': r['3dsdb_id'], 'alternative_download': r['alternative_download'], 'alternative_with_titlekey': r['alternative_with_titlekey'], 'best_alternative': r['best_alternative']})
-                    count_ok += 1
-                    count_all += 1
-        except FileNotFoundError:
-            pass
-
-        print('Merging all entries: ' + str(count_ok) + ' / ' + str(count_all) + ' entries', end = '\n')
-
-
-def analyse_missing():
-    with open(csv_eshop_analysis, 'r', encoding='utf-8') as ea_csv, open(csv_missing_retail_dumps_no_download, 'w', encoding='utf-8') as mrd_csv, open(csv_missing_downloads_only_retail, 'w', encoding='utf-8') as mdr_csv, open(csv_missing_titlekeys, 'w', encoding='utf-8') as mtk_csv, open(csv_missing_archive_eshop, 'w', encoding='utf-8') as mfe_csv, open(csv_missing_archive_all, 'w', encoding='utf-8') as mfa_csv, open(csv_unique_downloads, 'w', encoding='utf-8') as ud_csv:
-        ear = csv.DictReader(ea_csv)
         udw = csv.DictWriter(ud_csv, fieldnames=csv_fieldnames_eshop, lineterminator='\n')
         mrdw = csv.DictWriter(mrd_csv, fieldnames=csv_fieldnames_eshop, lineterminator='\n')
         mdrw = csv.DictWriter(mdr_csv, fieldnames=csv_fieldnames_eshop, lineterminator='\n')
         mtkw = csv.DictWriter(mtk_csv, fieldnames=csv_fieldnames_eshop, lineterminator='\n')
         mfew = csv.DictWriter(mfe_csv, fieldnames=csv_fieldnames_eshop, lineterminator='\n')
         mfaw = csv.DictWriter(mfa_csv, fieldnames=csv_fieldnames_eshop, lineterminator='\n')
+        eaw.writeheader()
         udw.writeheader()
         mrdw.writeheader()
         mdrw.writeheader()
@@ -729,17 +2011,20 @@ def analyse_missing():
         m_titlekey = 0
         m_archive_eshop = 0
         m_archive_all = 0
-        count_all = 0
+        count_all = len(merged_eshop_titles) + len(missing_3dsdb_rows)
+        count_ok = 0
+        progress = Progress('Analysing all entries', count_all)
 
-        for r in ear:
-            is_unique = r['best_alternative'] is None or r['best_alternative'] == ''
-            has_download = r['release_eshop'] is not None and r['release_eshop'] != ''
-            has_titlekey = r['titlekey_known'] is not None and r['titlekey_known'] == 'true'
-            has_cartdump = r['3dsdb_id'] is not None and r['3dsdb_id'] != ''
-            has_alt = r['alternative_download'] is not None and r['alternative_download'] != ''
-            has_alt_ttk = r['alternative_with_titlekey'] is not None and r['alternative_with_titlekey'] != ''
+        for r in eshop_analysis_rows():
+            progress.update(count_ok)
+            eaw.writerow(r)
 
-            print('Deeper analysis: ' + str(count_all) + ' entries', end = '\r')
+            is_unique = not r.get('best_alternative')
+            has_download = bool(r.get('release_eshop'))
+            has_titlekey = r.get('titlekey_known') == 'true'
+            has_cartdump = bool(r.get('3dsdb_id'))
+            has_alt = bool(r.get('alternative_download'))
+            has_alt_ttk = bool(r.get('alternative_with_titlekey'))
 
             if has_download and is_unique:
                 n_unique_downloads += 1
@@ -767,16 +2052,16 @@ def analyse_missing():
                     m_archive_all += 1
                     mfaw.writerow(r)
 
-            count_all += 1
+            count_ok += 1
 
-        print('Deeper analysis: ' + str(count_all) + ' entries', end = '\n')
+        progress.done('Analysing all entries: ' + str(count_ok) + ' / ' + str(count_all) + ' entries', count_ok)
 
         # print summary
         print('\n')
         print('Analysis summary:')
         print('--------------------------------')
 
-        print('Total titles found             :', str(count_all))
+        print('Total titles found             :', str(count_ok))
         print('Unique download titles         :', str(n_unique_downloads))
         if titlekeyurl:
             print('Titles with missing titlekeys  :', str(m_titlekey))
@@ -791,6 +2076,120 @@ def analyse_missing():
             print('No archival from eshop or 3dsdb:', str(m_archive_all))
 
 
+# fields of a merged title kept in the snapshot of the last run, along with a hash of its content
+snapshot_fields = ['eshop_id', 'name', 'publisher', 'size', 'release_eshop', 'release_retail', 'score', 'votes', 'eshop_regions', 'titlekey_known', 'best_price', 'best_price_region']
+
+
+def snapshot_content(xml):
+    # content XML without what depends on the position of the title in the listing, its index
+    # and the whitespace between the elements
+    xml = re.sub(rb'^(<content\b[^>]*?) index="\d+"', rb'\1', xml, count=1)
+    return re.sub(rb'>\s+<', b'><', xml)
+
+
+def snapshot_title(et):
+    h = hashlib.sha1(snapshot_content(et.xml))
+    h.update(et.ec_info or b'')
+    h.update(repr((et.retail_sales, et.eshop_sales, et.demo_available, et.aoc_available, et.release_eshop, et.release_retail, et.stars)).encode('utf-8'))
+    return {'hash': h.hexdigest(), 'eshop_id': et.eshop_id, 'name': et.name, 'publisher': et.publisher, 'size': et.ec_size, 'release_eshop': et.release_eshop, 'release_retail': et.release_retail,
+            'score': et.score, 'votes': et.stars[0] if et.score is not None else None, 'eshop_regions': '/'.join(region_list(et.regions)),
+            'titlekey_known': bool(et.titlekey), 'best_price': et.p_best, 'best_price_region': et.p_region}
+
+
+def diff_eshop_snapshot(currency):
+    # compare the merged titles with the snapshot of the last run, by product code. only regions
+    # covered by both runs are compared, so runs on other regions don't show up as delistings.
+    path = dumpdest + '/snapshot-eshop.json'
+    prev = None
+    if os.path.isfile(path):
+        with open(path, 'r') as f:
+            prev = json.load(f)
+    titles = {et.product_code: snapshot_title(et) for et in merged_eshop_titles}
+    cur = {'regions': list(langs), 'currency': currency.upper() if currency else None, 'titles': titles}
+
+    if prev is None:
+        # nothing to compare with, don't leave change lists of an older run behind
+        for out in (csv_changes_new, csv_changes_delisted, csv_changes_changed, csv_changes_titlekeys, csv_changes_prices):
+            if os.path.isfile(out):
+                os.remove(out)
+        show_status('Comparing with last run: no snapshot yet')
+    else:
+        common = set(langs) & set(prev['regions'])
+        prices = prev['currency'] is not None and prev['currency'] == cur['currency']
+        with open(csv_changes_new, 'w', encoding='utf-8') as new_csv, open(csv_changes_delisted, 'w', encoding='utf-8') as del_csv, open(csv_changes_changed, 'w', encoding='utf-8') as chg_csv, open(csv_changes_titlekeys, 'w', encoding='utf-8') as ttk_csv, open(csv_changes_prices, 'w', encoding='utf-8') as prc_csv:
+            neww = csv.DictWriter(new_csv, fieldnames=csv_fieldnames_changes, lineterminator='\n')
+            delw = csv.DictWriter(del_csv, fieldnames=csv_fieldnames_changes, lineterminator='\n')
+            chgw = csv.DictWriter(chg_csv, fieldnames=csv_fieldnames_changes, lineterminator='\n')
+            ttkw = csv.DictWriter(ttk_csv, fieldnames=csv_fieldnames_changes, lineterminator='\n')
+            prcw = csv.DictWriter(prc_csv, fieldnames=csv_fieldnames_changes, lineterminator='\n')
+            for w in (neww, delw, chgw, ttkw, prcw):
+                w.writeheader()
+
+            count_new = 0
+            count_delisted = 0
+            count_changed = 0
+            count_titlekeys = 0
+            count_prices = 0
+            for pc in list(titles) + [pc for pc in prev['titles'] if not pc in titles]:
+                t = titles.get(pc)
+                t0 = prev['titles'].get(pc)
+                regs = set(t['eshop_regions'].split('/')) & common if t is not None else set()
+                regs0 = set(t0['eshop_regions'].split('/')) & common if t0 is not None else set()
+                t1 = t if t is not None else t0
+                row = {'product_code': pc, 'eshop_id': t1['eshop_id'], 'name': t1['name'], 'eshop_regions': t['eshop_regions'] if t is not None else ''}
+
+                if regs and not regs0:
+                    count_new += 1
+                    neww.writerow(row)
+                    continue
+                if regs0 - regs:
+                    count_delisted += 1
+                    delw.writerow(dict(row, delisted_regions='/'.join(l for l in prev['regions'] if l in regs0 - regs)))
+                if t is None or t0 is None:
+                    continue
+
+                if t['hash'] != t0['hash'] or regs != regs0:
+                    changed = [field for field in snapshot_fields if t[field] != t0[field] and not field in ('eshop_regions', 'titlekey_known', 'best_price', 'best_price_region')]
+                    if regs != regs0:
+                        changed.append('eshop_regions')
+                    count_changed += 1
+                    chgw.writerow(dict(row, changed_fields='/'.join(changed or ['content'])))
+                if t['titlekey_known'] and not t0['titlekey_known']:
+                    count_titlekeys += 1
+                    ttkw.writerow(row)
+                if prices and t['best_price_region'] not in (None, 'none') and t0['best_price_region'] not in (None, 'none') and float(t['best_price']) < float(t0['best_price']):
+                    count_prices += 1
+                    prcw.writerow(dict(row, previous_price=t0['best_price'], previous_price_region=t0['best_price_region'], best_price=t['best_price'], best_price_region=t['best_price_region']))
+
+        show_status('Comparing with last run: ' + str(count_new) + ' new, ' + str(count_delisted) + ' delisted, ' + str(count_changed) + ' changed, ' + str(count_titlekeys) + ' new titlekeys, ' + str(count_prices) + ' price drops')
+
+    with open(path + '.part', 'w') as f:
+        json.dump(cur, f)
+    os.replace(path + '.part', path)
+
+
+def run_stages(args, english_only):
+    if titlekeyurl:
+        run_stage('get_titlekeydb_data', get_titlekeydb_data)
+        run_stage('dump_titlekeydb', dump_titlekeydb)
+    run_stage('probe_regions', probe_regions)
+    if not args.list:
+        run_stage('get_3dsdb_content', get_3dsdb_content)
+        run_stage('get_eshop_content', get_eshop_content)
+        run_stage('analyse_3dsdb', analyse_3dsdb, english_only)
+    else:
+        run_stage('get_idlist_content', get_idlist_content, args.list)
+        run_stage('load_missing_3dsdb', load_missing_3dsdb)
+    if args.currency:
+        run_stage('add_eshop_prices', add_eshop_prices, args.currency)
+    run_stage('save_enriched_titles', save_enriched_titles, args.currency)
+    if catalog is not None:
+        run_stage('store_catalog', store_catalog, args.currency)
+    run_stage('build_eshop_analysis', build_eshop_analysis)
+    if not args.list:
+        run_stage('diff_eshop_snapshot', diff_eshop_snapshot, args.currency)
+
+
 if __name__ == '__main__':
     langs = langs_all
     english_only = False
@@ -804,7 +2203,15 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("-r", "--region", type=str, help="specify eshop region (english/main/all/XX)")
     parser.add_argument("-l", "--list", type=str, help="specify a file with titleid list")
-    parser.add_argument("-c", "--currency", type=str, help="check prices for titles, currency needs to be specified (slow)")
+    parser.add_argument("-c", "--currency", type=str, help="check prices for titles, currency needs to be specified")
+    parser.add_argument("-i", "--incremental", action="store_true", help="check all listing pages with the server, only changed pages and titles are downloaded")
+    parser.add_argument("--resume", action="store_true", help="continue an interrupted run from its checkpoint")
+    parser.add_argument("-n", "--no-cache", action="store_true", help="ignore cached responses from earlier runs")
+    parser.add_argument("-d", "--database", type=str, help="also store all data in an sqlite database")
+    parser.add_argument("-p", "--profile", action="store_true", help="run under cProfile, stats are written to the results")
+    parser.add_argument("-j", "--processes", type=int, help="number of processes to split the regions across (default: 1)")
+    parser.add_argument("--progress", choices=['tty', 'line', 'json'], help="progress output (default: tty on a terminal, line otherwise)")
+    parser.add_argument("-w", "--workers", type=int, help="number of parallel requests (default: " + str(fetch_threads) + ")")
     if not titlekeyurl:
         parser.add_argument("-t", "--titlekeyurl", type=str, help="specify titlekey page url (with http://)")
     args = parser.parse_args()
@@ -820,24 +2227,42 @@ if __name__ == '__main__':
         langs = [ args.region ]
         english_only = True
 
+    if args.workers:
+        fetch_threads = max(1, args.workers)
+    if args.processes:
+        scrape_processes = max(1, args.processes)
+    if args.progress:
+        progress_mode = args.progress
+    if args.no_cache:
+        cache_enabled = False
+    if args.incremental:
+        incremental = True
+
     if not titlekeyurl and args.titlekeyurl:
         titlekeyurl = args.titlekeyurl
 
     # make dirs for data
     os.makedirs(dumpdest, exist_ok=True)
     os.makedirs(resultdest, exist_ok=True)
+    os.makedirs(cachedest, exist_ok=True)
 
-    # get all required contents
-    if titlekeyurl:
-        get_titlekeydb_data()
-        dump_titlekeydb()
-    if not args.list:
-        get_3dsdb_content()
-        get_eshop_content()
-        analyse_3dsdb(english_only)
+    if args.database:
+        open_catalog(args.database)
+
+    start_checkpoint({'region': args.region, 'list': args.list, 'currency': args.currency, 'incremental': incremental, 'titlekeyurl': titlekeyurl}, args.resume)
+
+    # get all required contents, optionally under the profiler
+    t_run = time.perf_counter()
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.runcall(run_stages, args, english_only)
+        profiler.dump_stats(resultdest + '/profile.pstats')
+        print('\n')
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(25)
     else:
-        get_idlist_content(args.list)
-    if args.currency:
-        add_eshop_prices(args.currency)
-    build_eshop_analysis()
-    analyse_missing()
+        run_stages(args, english_only)
+    finish_checkpoint()
+    if catalog is not None:
+        catalog.close()
+    write_metrics_report(resultdest + '/metrics.json', time.perf_counter() - t_run)
+    prune_cache()